@@ -0,0 +1,51 @@
+# 公告歷史查詢工具
+# 使用方式：
+#   python -m announcement_history stats --since 2026-09-01 --until 2026-10-01
+#   python -m announcement_history user <user_id>
+#   python -m announcement_history reindex      重新索引歷史資料夾中尚未壓縮的封存
+#   python -m announcement_history maintain     壓縮較舊的封存並刪除過期封存
+import argparse
+import json
+import os
+
+import app as bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Bot 公告歷史查詢')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stats_parser = subparsers.add_parser('stats', help='期間內的發送統計')
+    stats_parser.add_argument('--since', help='起始日期 YYYY-MM-DD（含）')
+    stats_parser.add_argument('--until', help='結束日期 YYYY-MM-DD（不含）')
+
+    user_parser = subparsers.add_parser('user', help='某位用戶收過的公告')
+    user_parser.add_argument('user_id')
+    user_parser.add_argument('--limit', type=int, default=50)
+
+    subparsers.add_parser('reindex', help='重新索引歷史資料夾中的封存')
+    subparsers.add_parser('maintain', help='壓縮與清理歷史封存')
+
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        result = bot.query_history_stats(bot.parse_date_ms(args.since), bot.parse_date_ms(args.until))
+    elif args.command == 'user':
+        result = bot.query_user_deliveries(args.user_id, args.limit)
+    elif args.command == 'reindex':
+        result = []
+        for entry in sorted(os.listdir(bot.HISTORY_FOLDER)):
+            path = os.path.join(bot.HISTORY_FOLDER, entry)
+            # 已壓縮成 tar.gz 的資料夾封存無法直接讀取，略過
+            if entry.endswith('.tar.gz'):
+                continue
+            bot.index_announcement_history(path)
+            result.append(path)
+    else:
+        result = bot.maintain_history_archives()
+
+    print(json.dumps(result, ensure_ascii=False, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# 獨立的公告發送程序：只負責公告，不與 Flask webhook 伺服器共用程序與 GIL
+# 使用方式：python -m announcement_worker --processes 4 --rate 200
+# 網頁程序請設定 ANNOUNCEMENT_DELIVERY=worker，避免網頁程序內的背景任務也搶著發送
+import argparse
+import logging
+import os
+import multiprocessing
+import time
+import zlib
+from multiprocessing import Pool
+
+from linebot.v3.messaging import (
+    ApiClient
+)
+
+import app as bot
+
+
+logger = logging.getLogger('announcement_worker')
+
+# 每個子程序各自的 LINE API 連線池
+_api_client = None
+_line_bot_api = None
+# 主程序失去租約時設定，子程序看到後立刻停止發送
+_stop_event = None
+
+
+# 子程序初始化：建立自己的連線池，整個子程序生命週期重複使用
+def init_shard(stop_event):
+    global _api_client, _line_bot_api, _stop_event
+    _api_client = ApiClient(bot.configuration)
+    _line_bot_api = bot.GuardedMessagingApi(_api_client)
+    _stop_event = stop_event
+
+
+# 依 user_id 分配分片，同一位接收者永遠落在同一個分片
+def shard_of(user_id, shards):
+    return zlib.crc32(user_id.encode('utf-8')) % shards
+
+
+# 在子程序中發送一個分片的接收者，依分配到的速率限制節流
+# 每個子程序各自開啟 status.bin 的 mmap，直接原地更新自己負責的接收者狀態
+def deliver_shard(args):
+    path, recipients, rate, deadline = args
+    interval = 1.0 / rate if rate > 0 else 0
+    next_send_at = time.monotonic()
+    sent = 0
+
+    with bot.CompactAnnouncement(path) as announcement:
+        for index, recipient in recipients:
+            # 時間用完或主程序失去租約就停下，剩下的留到下一輪
+            if time.time() >= deadline or _stop_event.is_set():
+                break
+            # LINE API 故障時暫停，等下一輪再試
+            if bot.circuit_breakers['push'].is_open():
+                break
+
+            # 控制發送速率，讓所有分片加起來不超過整體上限
+            if interval:
+                wait = next_send_at - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                next_send_at = max(next_send_at, time.monotonic()) + interval
+
+            status = bot.send_announcement_to(_line_bot_api, announcement.header, recipient)
+            if status != bot.STATUS_PENDING:
+                announcement.mark(index, status)
+            if status == bot.STATUS_SENT:
+                sent += 1
+
+    return sent
+
+
+# 在子程序中以 multicast 發送分配到的幾批接收者；rate 與 deliver_shard 相同是每秒最多發送幾則，
+# 依每批的接收者人數節流，而不是依請求次數
+def deliver_batches(args):
+    path, batches, rate, deadline = args
+    interval = 1.0 / rate if rate > 0 else 0
+    next_send_at = time.monotonic()
+    sent = 0
+
+    with bot.CompactAnnouncement(path) as announcement:
+        for start, batch in batches:
+            if time.time() >= deadline or _stop_event.is_set():
+                break
+            if bot.circuit_breakers['multicast'].is_open():
+                break
+
+            if interval:
+                wait = next_send_at - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                next_send_at = max(next_send_at, time.monotonic()) + interval * len(batch)
+
+            status = bot.send_announcement_batch(_line_bot_api, announcement.header, start, batch)
+            if status != bot.STATUS_PENDING:
+                for index, _ in batch:
+                    announcement.mark(index, status)
+            if status == bot.STATUS_SENT:
+                sent += len(batch)
+
+    return sent
+
+
+# 等待子程序完成，期間依經過時間續約；續約失敗時通知子程序停止，回傳是否仍持有租約
+def wait_with_lease(async_result, stop_event):
+    while not async_result.ready():
+        async_result.wait(bot.ANNOUNCEMENT_LEASE_RENEW_INTERVAL)
+        if not async_result.ready() and not bot.acquire_lease(bot.ANNOUNCEMENT_LEASE, bot.ANNOUNCEMENT_LEASE_TTL):
+            logger.warning("公告發送租約已被其他程序取得，停止本輪發送")
+            stop_event.set()
+            async_result.wait()
+            return False
+    return True
+
+
+# 執行一輪發送：取得租約、分片發送，各分片直接寫回共用的公告狀態
+def run_round(pool, stop_event, processes, rate, round_seconds):
+    if not bot.acquire_lease(bot.ANNOUNCEMENT_LEASE, bot.ANNOUNCEMENT_LEASE_TTL):
+        return {'status': 'standby'}
+
+    announcement = bot.load_announcement()
+    if announcement is None:
+        return {'status': 'idle'}
+
+    try:
+        sent = 0
+        lease_held = True
+        stop_event.clear()
+        if announcement.count_pending() and announcement.multicast:
+            # 依目標客群建立的公告：整批輪流分配給各子程序
+            shards = [[] for _ in range(processes)]
+            for number, batch in enumerate(announcement.iter_pending_batches(bot.MULTICAST_MAX_RECIPIENTS)):
+                shards[number % processes].append(batch)
+
+            deadline = time.time() + round_seconds
+            jobs = [(announcement.path, shard, rate / processes, deadline) for shard in shards if shard]
+            async_result = pool.map_async(deliver_batches, jobs)
+            lease_held = wait_with_lease(async_result, stop_event)
+            sent = sum(async_result.get())
+        elif announcement.count_pending():
+            # 依分片切分待發送的接收者
+            shards = [[] for _ in range(processes)]
+            for index, recipient in announcement.iter_pending():
+                shards[shard_of(recipient['user_id'], processes)].append((index, recipient))
+
+            deadline = time.time() + round_seconds
+            jobs = [(announcement.path, shard, rate / processes, deadline) for shard in shards if shard]
+            async_result = pool.map_async(deliver_shard, jobs)
+            lease_held = wait_with_lease(async_result, stop_event)
+            sent = sum(async_result.get())
+
+        remaining = announcement.count_pending()
+        result = {
+            'status': 'in_progress',
+            'message_id': announcement.message_id,
+            'sent': sent,
+            'remaining': remaining
+        }
+
+        # 租約已被其他程序取得，交給對方處理
+        if not lease_held:
+            result['status'] = 'standby'
+            return result
+
+        # 所有接收者都已處理，移動到歷史資料夾
+        if remaining == 0:
+            history_dir = bot.archive_announcement(announcement)
+            logger.info(f"公告處理完成，已移至歷史資料夾: {history_dir}")
+            result['status'] = 'done'
+        return result
+    finally:
+        announcement.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Bot 公告發送程序')
+    parser.add_argument('--processes', type=int,
+                        default=int(os.getenv('ANNOUNCEMENT_WORKER_PROCESSES', os.cpu_count() or 1)),
+                        help='發送用的子程序數量')
+    parser.add_argument('--rate', type=float,
+                        default=float(os.getenv('ANNOUNCEMENT_RATE_LIMIT', '100')),
+                        help='所有子程序合計每秒最多發送幾則（0 表示不限制）')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='沒有公告時每隔幾秒檢查一次')
+    parser.add_argument('--once', action='store_true',
+                        help='只執行一輪就結束')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+
+    # 每一輪不超過租約有效時間的一半；發送期間主程序另外依經過時間續約
+    round_seconds = min(bot.ANNOUNCEMENT_TIME_BUDGET, bot.ANNOUNCEMENT_LEASE_TTL / 2)
+    processes = max(1, args.processes)
+
+    last_maintenance = 0
+    stop_event = multiprocessing.Event()
+    with Pool(processes, initializer=init_shard, initargs=(stop_event,)) as pool:
+        try:
+            while True:
+                try:
+                    result = run_round(pool, stop_event, processes, args.rate, round_seconds)
+                    logger.info(f"公告發送結果: {result}")
+                    # 持有租約時順便定期整理歷史封存
+                    if result['status'] != 'standby' and time.time() - last_maintenance >= bot.HISTORY_MAINTENANCE_INTERVAL:
+                        last_maintenance = time.time()
+                        bot.maintain_history_archives()
+                except Exception as e:
+                    logger.error(f"公告發送程序發生錯誤: {str(e)}")
+                    result = {'status': 'error'}
+                if args.once:
+                    break
+                # 還有待發送的接收者就馬上進行下一輪；一則都沒送出（例如 LINE API 故障）時先休息
+                if result['status'] != 'in_progress' or result['sent'] == 0:
+                    time.sleep(args.interval)
+        finally:
+            bot.release_lease(bot.ANNOUNCEMENT_LEASE)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,33 @@ import threading
 import time
 import shutil
 import datetime
+import uuid
+import socket
+import sqlite3
+import atexit
+import mmap
+import gzip
 
 # for SSL
 import os
 import certifi
 # for record data
 import json
+import re
+import random
+import logging
+import logging.handlers
+import contextvars
+import signal
+import functools
+import contextlib
+import sys
+import math
+import collections
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
 # for interconnect
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 
 from linebot.v3 import (
     WebhookHandler
@@ -52,6 +71,9 @@ from linebot.v3.messaging import (
     BroadcastRequest,
     MulticastRequest
 )
+from linebot.v3.messaging.exceptions import (
+    ApiException
+)
 
 
 
@@ -65,11 +87,98 @@ line_handler = WebhookHandler(os.getenv('CHANNEL_SECRET')) # CHANNEL_SECRET
 
 
 
-# 用戶資料檔案路徑
-USER_DATA_FILE = 'user_data.json'
-# 公告檔案路徑
-ANNOUNCEMENT_FILE = 'announcement.json'
-HISTORY_FOLDER = './announcement_history'
+# 資料檔案（狀態資料庫、公告、歷史紀錄）預設存放的資料夾，也可以個別以環境變數指定路徑。
+# 公告的發送進度與租約都記錄在這裡，由排程端點分成多次呼叫發送時，每次呼叫都必須讀寫同一份資料：
+# 必須指向可寫入、持久且所有執行個體共用的儲存空間。Vercel 的部署檔案系統是唯讀的，/tmp 只屬於單一執行個體，
+# 都不符合這個條件
+DATA_DIR = os.getenv('DATA_DIR', '.')
+# 舊版用戶資料檔案路徑（用戶資料已移到狀態資料庫，啟動時若存在會自動匯入）
+USER_DATA_FILE = os.getenv('USER_DATA_FILE', os.path.join(DATA_DIR, 'user_data.json'))
+# 註冊事件的處理結果保留幾秒（LINE 重送同一事件時回覆相同結果）
+USER_EVENT_TTL = int(os.getenv('USER_EVENT_TTL', '86400'))
+# 最多保留幾條閒置的用戶資料庫連線
+USER_DB_POOL_SIZE = int(os.getenv('USER_DB_POOL_SIZE', '8'))
+# 批次匯入用戶時每批寫入幾筆
+USER_IMPORT_BATCH_SIZE = int(os.getenv('USER_IMPORT_BATCH_SIZE', '1000'))
+# 公告檔案路徑（舊格式單一 JSON，放入後會自動轉換為精簡格式資料夾）
+ANNOUNCEMENT_FILE = os.getenv('ANNOUNCEMENT_FILE', os.path.join(DATA_DIR, 'announcement.json'))
+ANNOUNCEMENT_DIR = os.getenv('ANNOUNCEMENT_DIR', os.path.join(DATA_DIR, 'announcement'))
+HISTORY_FOLDER = os.getenv('HISTORY_FOLDER', os.path.join(DATA_DIR, 'announcement_history'))
+# 排程端點每次最多可用的秒數（Vercel 等無伺服器環境有執行時間上限）
+ANNOUNCEMENT_TIME_BUDGET = float(os.getenv('ANNOUNCEMENT_TIME_BUDGET', '8'))
+# 每發送幾位接收者就保存一次進度
+ANNOUNCEMENT_CHECKPOINT_EVERY = int(os.getenv('ANNOUNCEMENT_CHECKPOINT_EVERY', '20'))
+# 排程端點驗證用密鑰（Vercel Cron 會以 Authorization: Bearer <CRON_SECRET> 呼叫）；未設定時排程端點一律拒絕。
+# vercel.json 中每分鐘一次的排程需要 Vercel Pro 以上方案（Hobby 方案只允許每天一次），也可以改由外部排程服務呼叫
+CRON_SECRET = os.getenv('CRON_SECRET')
+# 多個程序共用的狀態資料庫（租約等）
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', os.path.join(DATA_DIR, 'bot_state.db'))
+# 公告發送租約名稱與有效秒數：同時只有持有租約的程序會發送公告
+ANNOUNCEMENT_LEASE = 'announcement_sender'
+ANNOUNCEMENT_LEASE_TTL = float(os.getenv('ANNOUNCEMENT_LEASE_TTL', '20'))
+# 發送期間每隔多久續約一次（依經過時間而非發送人數，單次呼叫很慢時也不會讓租約過期）
+ANNOUNCEMENT_LEASE_RENEW_INTERVAL = ANNOUNCEMENT_LEASE_TTL / 3
+# 公告發送方式：thread 由網頁程序內的背景任務發送，worker 則交給獨立的 announcement_worker 程序
+ANNOUNCEMENT_DELIVERY = os.getenv('ANNOUNCEMENT_DELIVERY', 'thread')
+
+# 歷史封存超過幾天後壓縮、超過幾天後刪除原始封存（0 表示永久保留），以及每隔幾秒檢查一次
+HISTORY_COMPRESS_AFTER_DAYS = float(os.getenv('HISTORY_COMPRESS_AFTER_DAYS', '7'))
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', '365'))
+HISTORY_MAINTENANCE_INTERVAL = float(os.getenv('HISTORY_MAINTENANCE_INTERVAL', '3600'))
+# 管理用端點的驗證密鑰（未設定時管理端點一律拒絕）
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# 呼叫 LINE API 的連線／讀取逾時秒數
+LINE_REQUEST_TIMEOUT = (
+    float(os.getenv('LINE_CONNECT_TIMEOUT', '3')),
+    float(os.getenv('LINE_READ_TIMEOUT', '10'))
+)
+# 斷路器：連續失敗幾次後開啟，開啟幾秒後再試探
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+# 追蹤：超過幾毫秒的事件一定記錄、其餘事件的抽樣比例、單一追蹤最多幾個 span
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '200'))
+# 追蹤記錄檔與輪替設定
+TRACE_LOG_FILE = os.getenv('TRACE_LOG_FILE', 'trace_spans.jsonl')
+TRACE_LOG_MAX_BYTES = int(os.getenv('TRACE_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.getenv('TRACE_LOG_BACKUPS', '5'))
+# 效能分析：輸出資料夾、取樣間隔（秒）、單次最長分析秒數、收到 SIGUSR2 時分析幾秒
+PROFILE_DIR = os.getenv('PROFILE_DIR', './profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '300'))
+PROFILE_SIGNAL_SECONDS = float(os.getenv('PROFILE_SIGNAL_SECONDS', '30'))
+# 功能選單等 Flex 訊息的快取數量
+FLEX_CACHE_SIZE = int(os.getenv('FLEX_CACHE_SIZE', '1024'))
+# 匯入時就在背景預熱（載入用戶目錄、建立 Flex 範本、建立 LINE API 連線）；
+# 預設不開啟，改在網頁伺服器收到第一個請求（通常是 /readyz）時才開始，命令列工具匯入 app 時不會預熱
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '0') == '1'
+# 預熱失敗後重試的最長間隔（秒），間隔從 1 秒開始每次加倍
+WARMUP_RETRY_MAX_DELAY = float(os.getenv('WARMUP_RETRY_MAX_DELAY', '60'))
+# 預熱時是否實際呼叫一次 LINE API 建立連線
+WARMUP_CONNECT = os.getenv('WARMUP_CONNECT', '1') == '1'
+# 一次 push 最多的訊息數（LINE API 上限）
+PUSH_MAX_MESSAGES = 5
+# 發給同一接收者的 push 在這段時間（秒）內會合併成一次請求，0 表示不合併
+OUTBOUND_COALESCE_WINDOW = float(os.getenv('OUTBOUND_COALESCE_WINDOW', '0.3'))
+# 轉發時等待發送結果的最長秒數
+OUTBOUND_SEND_TIMEOUT = float(os.getenv('OUTBOUND_SEND_TIMEOUT', '15'))
+# 用戶傳來的事件沒有用到回覆權杖時，保留幾秒給發給該用戶的訊息改用免費的 reply 送出
+# （LINE 的回覆權杖只在收到事件後短時間內有效，這裡保守取較短的時間）
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '20'))
+# 轉發訊息的速率限制：每位發送者每分鐘可轉發幾次（可瞬間連續幾次），以及全體每分鐘最多發出幾則
+FORWARD_USER_RATE_PER_MINUTE = float(os.getenv('FORWARD_USER_RATE_PER_MINUTE', '10'))
+FORWARD_USER_BURST = float(os.getenv('FORWARD_USER_BURST', '5'))
+FORWARD_GLOBAL_RATE_PER_MINUTE = float(os.getenv('FORWARD_GLOBAL_RATE_PER_MINUTE', '600'))
+FORWARD_GLOBAL_BURST = float(os.getenv('FORWARD_GLOBAL_BURST', '600'))
+# 訊息額度快取秒數，以及剩餘額度低於多少則時停止轉發、保留給公告
+QUOTA_CACHE_TTL = float(os.getenv('QUOTA_CACHE_TTL', '300'))
+QUOTA_LOW_WATERMARK = int(os.getenv('QUOTA_LOW_WATERMARK', '100'))
+# 一次 multicast 最多的收件人數（LINE API 上限）
+MULTICAST_MAX_RECIPIENTS = 500
+# 回覆轉發結果時最多列出幾位收件人名稱
+FORWARD_NAME_DISPLAY_LIMIT = 20
 
 # 確保歷史資料夾存在
 if not os.path.exists(HISTORY_FOLDER):
@@ -85,9 +194,402 @@ app = Flask(__name__)
 user_states = {}
 # 訊息轉發狀態追蹤
 message_forwarding = {}
+# 公告處理鎖，避免同時處理同一份公告
+announcement_lock = threading.Lock()
+# 本程序的隨機識別碼，用於租約擁有者
+WORKER_INSTANCE_ID = uuid.uuid4().hex[:8]
+# 共用的 LINE API 連線池
+shared_api_client_instance = None
+shared_api_client_lock = threading.Lock()
+# 預熱完成後才會開始回報已就緒（/readyz）
+app_ready = threading.Event()
+# 目前的用戶目錄（UserDirectory），資料庫有變動時建立新的目錄再整個替換
+user_directory = None
+user_directory_lock = threading.RLock()
+# 重複使用的用戶資料庫連線（閒置的連線），fork 之後不沿用父程序的連線
+user_db_pool = []
+user_db_pool_pid = None
+user_db_pool_lock = threading.Lock()
+user_db_migrated = False
+# 狀態資料庫的資料表是否已建立（每個程序只需要建立一次）
+state_db_initialized = False
+state_db_init_lock = threading.Lock()
+# 統計數據（例如合併省下的請求數），可由 /metrics 查詢
+metrics = collections.Counter()
+metrics_lock = threading.Lock()
+
+# 記錄統計數據（次數累加）
+def record_metric(name, value=1):
+    with metrics_lock:
+        metrics[name] += value
+
+# 取得目前統計數據的快照
+def get_metrics_snapshot():
+    with metrics_lock:
+        return dict(metrics)
+
+# 追蹤（trace）：每個 webhook 事件一筆，trace_id 使用 webhookEventId；
+# 事件處理中的各個階段（讀取用戶資料、建立 Flex、呼叫 LINE API…）記為 span。
+# 只有超過 TRACE_SLOW_MS 的追蹤，以及依 TRACE_SAMPLE_RATE 隨機抽樣的追蹤會輸出
+class Trace:
+    __slots__ = ('trace_id', 'spans', 'dropped', 'stack')
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self.dropped = 0
+        self.stack = []
+
+# 目前執行中的追蹤（每個執行緒／context 各自獨立）
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# 記錄一個 span；沒有進行中的追蹤時不做任何事
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    span = {
+        'trace_id': trace.trace_id,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': trace.stack[-1]['span_id'] if trace.stack else None,
+        'name': name,
+        'start': time.time(),
+        'attributes': attributes
+    }
+    started = time.perf_counter()
+    trace.stack.append(span)
+    try:
+        yield
+    except Exception as e:
+        span['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        trace.stack.pop()
+        span['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        # 避免大量發送時單一追蹤佔用太多記憶體
+        if len(trace.spans) < TRACE_MAX_SPANS:
+            trace.spans.append(span)
+        else:
+            trace.dropped += 1
+
+# 開始一筆追蹤，結束時依門檻與抽樣率決定是否輸出
+@contextlib.contextmanager
+def start_trace(name, trace_id=None, **attributes):
+    trace = Trace(trace_id or uuid.uuid4().hex)
+    token = current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        with trace_span(name, **attributes):
+            yield trace
+    finally:
+        current_trace.reset(token)
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE:
+            try:
+                span_exporter.export(trace)
+            except Exception as e:
+                app.logger.error(f"輸出追蹤資料失敗: {str(e)}")
+
+# 追蹤輸出介面：實作 export(trace) 即可改送到其他系統
+class SpanExporter:
+    def export(self, trace):
+        raise NotImplementedError
+
+# 寫入本機 JSONL 檔（每行一個 span），檔案超過大小上限時自動輪替
+class JsonlSpanExporter(SpanExporter):
+    def __init__(self, path, max_bytes, backup_count):
+        self.logger = logging.getLogger('linebot.trace')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.handler = None
+        self.lock = threading.Lock()
+
+    def export(self, trace):
+        # 第一次輸出時才建立檔案
+        if self.handler is None:
+            with self.lock:
+                if self.handler is None:
+                    handler = logging.handlers.RotatingFileHandler(
+                        self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding='utf-8'
+                    )
+                    handler.setFormatter(logging.Formatter('%(message)s'))
+                    self.logger.addHandler(handler)
+                    self.handler = handler
+        for span in trace.spans:
+            self.logger.info(json.dumps(span, ensure_ascii=False, default=str))
+        if trace.dropped:
+            self.logger.info(json.dumps({'trace_id': trace.trace_id, 'name': 'dropped_spans', 'count': trace.dropped}))
+
+span_exporter = JsonlSpanExporter(TRACE_LOG_FILE, TRACE_LOG_MAX_BYTES, TRACE_LOG_BACKUPS)
+
+# 事件處理函式的裝飾器：以 webhookEventId 作為 trace_id 追蹤整個事件處理
+def traced_event(handler):
+    @functools.wraps(handler)
+    def wrapper(event):
+        with start_trace(
+            handler.__name__,
+            trace_id=getattr(event, 'webhook_event_id', None),
+            event_type=getattr(event, 'type', None),
+            user_id=getattr(event.source, 'user_id', None),
+            is_redelivery=getattr(getattr(event, 'delivery_context', None), 'is_redelivery', None)
+        ):
+            return handler(event)
+    return wrapper
+
+# 將 Flex 內容轉為 FlexContainer（驗證 JSON 結構），並記錄耗時
+def flex_from_dict(flex_content):
+    with trace_span('flex.from_dict'):
+        return FlexContainer.from_dict(flex_content)
+
+# 取樣式效能分析器：分析期間由背景執行緒每隔 PROFILE_SAMPLE_INTERVAL 秒
+# 透過 sys._current_frames() 擷取正在處理 webhook 的執行緒的呼叫堆疊並累計次數，
+# 結束時輸出 flame graph 工具（flamegraph.pl、speedscope）可讀的 folded stacks 格式
+class SamplingProfiler:
+    def __init__(self, output_dir, interval):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active_threads = set()
+        self.stacks = collections.Counter()
+        self.running = False
+        self.deadline = None
+        self.requests_left = None
+        self.samples = 0
+        self.started_at = None
+        self.last_output = None
+
+    # 開始分析：duration 秒後或處理完 max_requests 個請求後結束（以先到者為準）
+    def start(self, duration=None, max_requests=None):
+        duration = min(duration or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.deadline = time.monotonic() + duration
+            self.requests_left = max_requests
+        threading.Thread(target=self._sample_loop, daemon=True).start()
+        app.logger.info(f"開始效能分析：最多 {duration} 秒" + (f"或 {max_requests} 個請求" if max_requests else ""))
+        return True
+
+    # 提前結束分析（取樣執行緒會在下一次取樣時寫出結果）
+    def stop(self):
+        with self.lock:
+            self.deadline = time.monotonic()
+
+    # 標記目前執行緒正在處理 webhook 請求，只有這些執行緒會被取樣
+    @contextlib.contextmanager
+    def track_request(self):
+        if not self.running:
+            yield
+            return
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.active_threads.add(thread_id)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_threads.discard(thread_id)
+                if self.requests_left is not None:
+                    self.requests_left -= 1
+                    if self.requests_left <= 0:
+                        self.deadline = time.monotonic()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        try:
+            while time.monotonic() < self.deadline:
+                with self.lock:
+                    thread_ids = list(self.active_threads)
+                if thread_ids:
+                    frames = sys._current_frames()
+                    for thread_id in thread_ids:
+                        frame = frames.get(thread_id)
+                        if frame is not None and thread_id != own_id:
+                            self.stacks[self._fold(frame)] += 1
+                            self.samples += 1
+                time.sleep(self.interval)
+            self.last_output = self._write()
+            app.logger.info(f"效能分析結束，共 {self.samples} 個樣本，結果: {self.last_output}")
+        except Exception as e:
+            app.logger.error(f"效能分析失敗: {str(e)}")
+        finally:
+            with self.lock:
+                self.running = False
+                self.active_threads.clear()
+
+    # 將堆疊轉為 folded 格式：由外而內以分號串接「函式 (檔名:函式起始行號)」
+    # 使用函式起始行號而非執行中的行號，同一函式的樣本才會合併在一起
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        timestamp = datetime.datetime.fromtimestamp(self.started_at).strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.output_dir, f"profile-{timestamp}-{os.getpid()}.folded")
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(temp_file, path)
+        return path
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'running': self.running,
+                'samples': self.samples,
+                'seconds_left': round(max(0, self.deadline - time.monotonic()), 1) if self.running else 0,
+                'requests_left': self.requests_left if self.running else None,
+                'last_output': self.last_output
+            }
+
+profiler = SamplingProfiler(PROFILE_DIR, PROFILE_SAMPLE_INTERVAL)
+
+# 斷路器開啟時直接拒絕呼叫所拋出的例外
+class CircuitOpenError(Exception):
+    pass
+
+# 斷路器：連續失敗達到門檻就開啟，開啟期間直接失敗不再呼叫 LINE API，
+# 經過 reset_timeout 秒後放行一次試探請求，成功就恢復，失敗就再開啟
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    # 呼叫前檢查，開啟中則拋出 CircuitOpenError
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 放行一次試探請求
+                self.state = 'half_open'
+                return
+        record_metric(f'circuit_{self.name}_rejected')
+        raise CircuitOpenError(f"LINE API ({self.name}) 暫時無法使用，請稍後再試")
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    record_metric(f'circuit_{self.name}_opened')
+                    app.logger.warning(f"LINE API ({self.name}) 連續失敗，斷路器開啟 {self.reset_timeout} 秒")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    # 距離可以再試探還有幾秒（未開啟時為 0）；試探請求進行中時其他呼叫仍會被拒絕，
+    # 以試探請求最長的逾時時間作為等待秒數
+    def retry_after(self):
+        with self.lock:
+            if self.state == 'half_open':
+                return sum(LINE_REQUEST_TIMEOUT)
+            if self.state != 'open':
+                return 0
+            return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def is_open(self):
+        return self.retry_after() > 0
+
+    def snapshot(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures}
 
-# 初始化或讀取用戶資料
+# 依端點類別區分的斷路器
+circuit_breakers = {
+    name: CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+    for name in ('reply', 'push', 'multicast')
+}
+
+# 判斷錯誤是否代表 LINE 服務本身有問題（逾時、連線失敗、5xx、429），
+# 一般的 4xx（例如回覆權杖已失效）不計入斷路器
+def is_service_failure(e):
+    if isinstance(e, ApiException):
+        return not e.status or e.status >= 500 or e.status == 429
+    return True
+
+# 加上逾時設定與斷路器的 MessagingApi
+class GuardedMessagingApi(MessagingApi):
+    def _guarded_call(self, name, func, *args, **kwargs):
+        breaker = circuit_breakers[name]
+        breaker.before_call()
+        kwargs.setdefault('_request_timeout', LINE_REQUEST_TIMEOUT)
+        try:
+            with trace_span(f'line.{name}'):
+                result = func(*args, **kwargs)
+        except Exception as e:
+            if is_service_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+    def reply_message(self, reply_message_request, *args, **kwargs):
+        send = super().reply_message
+
+        # 事件處理中實際送出過自己的回覆權杖，這個權杖就不能再給其他訊息使用；
+        # 斷路器開啟而沒有送出時權杖仍可留給之後的訊息
+        def attempt(*args, **kwargs):
+            event_reply = current_event_reply.get()
+            if event_reply is not None and event_reply['token'] == reply_message_request.reply_token:
+                event_reply['used'] = True
+            return send(*args, **kwargs)
+        return self._guarded_call('reply', attempt, reply_message_request, *args, **kwargs)
+
+    def push_message(self, *args, **kwargs):
+        return self._guarded_call('push', super().push_message, *args, **kwargs)
+
+    def multicast(self, *args, **kwargs):
+        return self._guarded_call('multicast', super().multicast, *args, **kwargs)
+
+# 全程序共用的 LINE API 連線池（每個請求都建立新的 ApiClient 會重新建立連線）
+def get_api_client():
+    global shared_api_client_instance
+    if shared_api_client_instance is None:
+        with shared_api_client_lock:
+            if shared_api_client_instance is None:
+                shared_api_client_instance = ApiClient(configuration)
+    return shared_api_client_instance
+
+# 以 with 語法取得共用的 ApiClient，離開時不會關閉連線池
+@contextlib.contextmanager
+def shared_api_client():
+    yield get_api_client()
+
+# 讀取舊版 user_data.json 用戶資料（匯入用戶資料庫時使用）
 def load_user_data():
+    with trace_span('load_user_data'):
+        return _load_user_data()
+
+def _load_user_data():
     if os.path.exists(USER_DATA_FILE):
         try:
             with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
@@ -98,8 +600,10 @@ def load_user_data():
                     app.logger.warning("User data file exists but is empty. Returning empty dict.")
                     return {}
         except json.JSONDecodeError as e:
-            app.logger.error(f"JSON decode error: {str(e)}. Creating new user data file.")
-            # 如果檔案存在但格式不正確，建立一個新的空字典
+            # 如果檔案存在但格式不正確，先把原檔改名保留下來再建立新的空字典，避免用戶資料被直接覆蓋
+            corrupt_file = f"{USER_DATA_FILE}.corrupt-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            os.replace(USER_DATA_FILE, corrupt_file)
+            app.logger.error(f"JSON decode error: {str(e)}. Moved broken user data to {corrupt_file} and created a new user data file.")
             with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
                 json.dump({}, f)
             return {}
@@ -109,38 +613,495 @@ def load_user_data():
             json.dump({}, f)
         return {}
 
-# 儲存用戶資料
-def save_user_data(user_data):
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(user_data, f, ensure_ascii=False, indent=4)
+# 將用戶目錄寫成 JSON 檔：逐筆寫出與 json.dump(indent=4) 相同的格式，不需要先組成整個 dict
+# 先寫入暫存檔再取代，避免讀到寫到一半的檔案
+def save_user_directory(directory, path):
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write("{")
+        separator = "\n"
+        for user_id, name, registered_at, tags in directory.rows():
+            f.write(
+                f'{separator}    {json.dumps(user_id)}: {{\n'
+                f'        "name": {json.dumps(name, ensure_ascii=False)},\n'
+                f'        "registered_at": {registered_at}'
+                + (f',\n        "tags": {json.dumps(list(tags), ensure_ascii=False)}' if tags else '') +
+                '\n    }'
+            )
+            separator = ",\n"
+        f.write("\n}" if len(directory) else "}")
+    os.replace(tmp_file, path)
+
+# 將目前的用戶資料備份為 JSON 檔（與舊版 user_data.json 格式相同），回傳備份檔路徑（沒有用戶時回傳 None）
+def backup_user_data():
+    directory = get_user_directory()
+    if not len(directory):
+        return None
+    backup_file = f"{USER_DATA_FILE}.bak-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    save_user_directory(directory, backup_file)
+    return backup_file
+
+# 精簡的用戶目錄：以欄位陣列儲存，取代每位用戶一個 dict 的結構
+#   user_ids       用戶 ID（sys.intern 過，與其他地方共用同一個字串物件）
+#   names          用戶名稱
+#   registered_at  註冊時間（毫秒），存放在 array('q') 中
+#   tags           用戶標籤（tuple，沒有標籤的用戶共用同一個空 tuple）
+#   replaced_in    這一列被新的一列取代時的資料庫版本（0 表示仍有效），存放在 array('q') 中
+#   index          用戶 ID -> 最新的列號
+#   name_index     名稱（casefold）-> 列號
+#   segments       標籤 -> 擁有該標籤的用戶 ID 集合（反向索引）
+#   size           這個版本看得到的列數
+#   count          這個版本的用戶數
+#   version        已套用到的用戶資料庫版本
+# 作為用戶資料庫的快取，多個執行緒可以不加鎖讀取。資料庫有變動時由 get_user_directory()
+# 以 updated() 建立新的版本再整個替換：欄位只在尾端附加，已經寫入的列不再修改（用戶有變動時附加新的一列，
+# 舊的一列標記為已取代），索引只逐一替換單一鍵，segments 只複製有變動的標籤集合，
+# 舊版本仍可繼續安全讀取，每次更新的成本只與變動的用戶數有關。
+# 走訪（items、rows、segments）只看到這個版本的用戶；查詢單一用戶（get、find_by_name 等）一律取得最新寫入的資料
+class UserDirectory:
+    __slots__ = (
+        'user_ids', 'names', 'registered_at', 'tags', 'replaced_in', 'index', 'name_index',
+        'segments', 'size', 'count', 'version'
+    )
+
+    def __init__(self, version=0):
+        self.user_ids = []
+        self.names = []
+        self.registered_at = array('q')
+        self.tags = []
+        self.replaced_in = array('q')
+        self.index = {}
+        self.name_index = {}
+        self.segments = {}
+        self.size = 0
+        self.count = 0
+        self.version = version
+
+    # 名稱索引的鍵：casefold 後與原名稱相同時直接共用原本的字串，不另外佔用記憶體
+    @staticmethod
+    def _name_key(name):
+        key = name.casefold()
+        return name if key == name else key
+
+    # 標籤統一整理為排序過、不重複的 tuple，標籤字串 intern 後在所有用戶間共用
+    @staticmethod
+    def _normalize_tags(tags):
+        if not tags:
+            return ()
+        return tuple(sorted({sys.intern(tag) for tag in tags}))
+
+    # 建立套用了變動用戶 rows [(user_id, name, registered_at, tags), ...] 的新版本，原本的版本不受影響；
+    # 已取代的列比有效的用戶還多時整理成新的目錄（攤提後每次更新仍只與變動的用戶數有關）
+    def updated(self, rows, version):
+        directory = object.__new__(UserDirectory)
+        for slot in UserDirectory.__slots__:
+            setattr(directory, slot, getattr(self, slot))
+        directory.segments = dict(self.segments)
+        directory._apply(rows, version)
+        if directory.size - directory.count > directory.count:
+            directory = directory.compacted()
+        return directory
+
+    # 只保留有效的列，建立不與目前版本共用任何欄位的新目錄
+    def compacted(self):
+        directory = UserDirectory()
+        directory._apply(self.rows(), self.version)
+        return directory
+
+    # 依序套用變動的用戶（tags 為 None 時保留原本的標籤）
+    def _apply(self, rows, version):
+        owned = set()
+        for user_id, name, registered_at, tags in rows:
+            user_id = sys.intern(user_id)
+            old_row = self.index.get(user_id)
+            if old_row is None:
+                old_tags = ()
+                self.count += 1
+            else:
+                old_tags = self.tags[old_row]
+            new_tags = old_tags if tags is None else self._normalize_tags(tags)
+
+            # 先補齊各欄位再更新索引，其他執行緒查到這一列時資料已完整
+            row = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.names.append(name)
+            self.registered_at.append(registered_at)
+            self.tags.append(new_tags)
+            self.replaced_in.append(0)
+            self.size = row + 1
+            self.index[user_id] = row
+            self.name_index[self._name_key(name)] = row
+            if old_row is not None:
+                self.replaced_in[old_row] = version
+                # 舊名稱可能已被其他用戶取用，只移除仍指向舊列的索引
+                old_key = self._name_key(self.names[old_row])
+                if self.name_index.get(old_key) == old_row:
+                    del self.name_index[old_key]
+            self._update_segments(user_id, old_tags, new_tags, owned)
+        self.version = version
+
+    # 只調整新舊標籤有差異的反向索引；舊版本共用的集合先複製一份再修改（owned 為已複製過的標籤）
+    def _update_segments(self, user_id, old_tags, new_tags, owned):
+        for tag in set(old_tags).symmetric_difference(new_tags):
+            if tag not in owned:
+                self.segments[tag] = set(self.segments.get(tag, ()))
+                owned.add(tag)
+            members = self.segments.setdefault(tag, set())
+            if tag in new_tags:
+                members.add(user_id)
+            else:
+                members.discard(user_id)
+                if not members:
+                    del self.segments[tag]
+
+    # 這個版本有效的列號（依寫入順序）
+    def _live_rows(self):
+        version = self.version
+        replaced_in = self.replaced_in
+        for row in range(self.size):
+            replaced = replaced_in[row]
+            if not replaced or replaced > version:
+                yield row
+
+    def _info(self, row):
+        info = {"name": self.names[row], "registered_at": self.registered_at[row]}
+        if self.tags[row]:
+            info["tags"] = list(self.tags[row])
+        return info
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def get_name(self, user_id):
+        row = self.index.get(user_id)
+        return None if row is None else self.names[row]
+
+    def get(self, user_id):
+        row = self.index.get(user_id)
+        return None if row is None else self._info(row)
+
+    def get_tags(self, user_id):
+        row = self.index.get(user_id)
+        return None if row is None else self.tags[row]
+
+    # 各標籤的人數
+    def segment_sizes(self):
+        return {tag: len(members) for tag, members in self.segments.items()}
+
+    # 以集合運算解析目標客群，只使用反向索引，不掃描整個目錄：
+    #   any   符合任一標籤（聯集）
+    #   all   同時符合所有標籤（交集）
+    #   none  排除擁有這些標籤的用戶
+    # 回傳依寫入順序排列的用戶 ID 列表
+    def resolve_segments(self, any_of=(), all_of=(), none_of=()):
+        if not any_of and not all_of:
+            raise ValueError("目標客群至少需要指定 any 或 all")
+        empty = frozenset()
+        if any_of:
+            selected = set().union(*(self.segments.get(tag, empty) for tag in any_of))
+        else:
+            # 從最小的集合開始取交集
+            all_of = sorted(all_of, key=lambda tag: len(self.segments.get(tag, empty)))
+            selected = set(self.segments.get(all_of[0], empty))
+            all_of = all_of[1:]
+        for tag in all_of:
+            selected &= self.segments.get(tag, empty)
+        for tag in none_of:
+            selected -= self.segments.get(tag, empty)
+        return sorted(selected, key=self.index.__getitem__)
+
+    def find_by_name(self, name):
+        row = self.name_index.get(name.casefold())
+        return None if row is None else self.user_ids[row]
+
+    # 依序列出 (user_id, name, registered_at, tags)
+    def rows(self):
+        for row in self._live_rows():
+            yield self.user_ids[row], self.names[row], self.registered_at[row], self.tags[row]
+
+    # 依序列出 (user_id, name)
+    def items(self):
+        return ((self.user_ids[row], self.names[row]) for row in self._live_rows())
+
+    # 轉回舊格式的 dict，用於寫入檔案
+    def to_dict(self):
+        return {self.user_ids[row]: self._info(row) for row in self._live_rows()}
+
+# 借用一條用戶資料庫連線（與租約等共用狀態資料庫），用完放回連線池重複使用；
+# 每個請求都可能在不同的執行緒上執行，因此不綁定執行緒
+@contextlib.contextmanager
+def user_db():
+    global user_db_pool, user_db_pool_pid, user_db_migrated
+    conn = None
+    with user_db_pool_lock:
+        if user_db_pool_pid != os.getpid():
+            user_db_pool = []
+            user_db_pool_pid = os.getpid()
+        if user_db_pool:
+            conn = user_db_pool.pop()
+    if conn is None:
+        conn = get_state_db(check_same_thread=False)
+        if not user_db_migrated:
+            migrate_user_data_file(conn)
+            user_db_migrated = True
+    try:
+        yield conn
+    finally:
+        # 例外中斷時不把進行到一半的交易留給下一個使用者
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        with user_db_pool_lock:
+            if user_db_pool_pid == os.getpid() and len(user_db_pool) < USER_DB_POOL_SIZE:
+                user_db_pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+# 在寫入交易中遞增用戶資料庫版本，回傳新的版本號；本次交易寫入的用戶都標記為這個版本
+def bump_user_store_version(conn):
+    conn.execute(
+        "INSERT INTO user_store (id, version) VALUES (1, 1) "
+        "ON CONFLICT (id) DO UPDATE SET version = version + 1"
+    )
+    return conn.execute("SELECT version FROM user_store WHERE id = 1").fetchone()[0]
+
+# 目前的用戶資料庫版本（還沒有任何用戶時為 0）
+def get_user_store_version(conn):
+    row = conn.execute("SELECT version FROM user_store WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+# 將舊版 user_data.json 匯入用戶資料庫，完成後將檔案改名保留；資料庫已有用戶時不重複匯入。
+# 舊資料中名稱不分大小寫重複的用戶，會在名稱後加上用戶 ID 末四碼以符合唯一索引
+def migrate_user_data_file(conn):
+    if not os.path.exists(USER_DATA_FILE):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            conn.execute("ROLLBACK")
+            return
+        version = bump_user_store_version(conn)
+        rows = []
+        name_keys = set()
+        for user_id, info in load_user_data().items():
+            name = info['name']
+            if name.casefold() in name_keys:
+                name = f"{name}#{user_id[-4:]}"
+                app.logger.warning(f"用戶 {user_id} 的名稱與其他用戶重複，改為 {name}")
+            name_keys.add(name.casefold())
+            tags = info.get('tags')
+            rows.append((
+                user_id, name, name.casefold(), info.get('registered_at') or 0,
+                json.dumps(tags, ensure_ascii=False) if tags else None, version
+            ))
+        conn.executemany(USER_UPSERT_SQL, rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    migrated_file = f"{USER_DATA_FILE}.migrated-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    os.replace(USER_DATA_FILE, migrated_file)
+    app.logger.info(f"已將 {len(rows)} 位用戶匯入用戶資料庫，原檔保留為 {migrated_file}")
+
+# 取得目前的用戶目錄；資料庫有變動時只讀取版本較新的用戶，建立新版本的目錄後再整個替換，
+# 其他執行緒不會看到套用到一半的目錄
+def get_user_directory():
+    global user_directory
+    with trace_span('user_store.directory'), user_db() as conn:
+        directory = user_directory
+        if directory is not None and directory.version == get_user_store_version(conn):
+            return directory
+
+        with user_directory_lock, trace_span('user_store.refresh'):
+            # 在同一個讀取交易中取得版本與變動的用戶，兩者一致
+            conn.execute("BEGIN")
+            try:
+                version = get_user_store_version(conn)
+                directory = user_directory
+                if directory is None or directory.version != version:
+                    base = directory if directory is not None else UserDirectory()
+                    rows = conn.execute(
+                        "SELECT user_id, name, registered_at, tags FROM users WHERE version > ? ORDER BY version, rowid",
+                        (base.version,)
+                    )
+                    try:
+                        directory = base.updated(
+                            ((user_id, name, registered_at, json.loads(tags) if tags else ())
+                             for user_id, name, registered_at, tags in rows),
+                            version
+                        )
+                    except BaseException:
+                        # 共用的欄位可能已附加了一部分，捨棄目前的目錄，下次重新完整載入
+                        user_directory = None
+                        raise
+                    user_directory = directory
+            finally:
+                conn.execute("COMMIT")
+            return directory
+
+# 新增或更新一位用戶；tags 為 NULL 時保留原本的標籤
+USER_UPSERT_SQL = """
+INSERT INTO users (user_id, name, name_key, registered_at, tags, version) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+    name = excluded.name,
+    name_key = excluded.name_key,
+    registered_at = excluded.registered_at,
+    tags = COALESCE(excluded.tags, users.tags),
+    version = excluded.version
+"""
+
+# 查詢某個 webhook 事件先前的註冊結果（沒有處理過時回傳 None）
+def get_user_event_result(event_id):
+    with user_db() as conn:
+        row = conn.execute("SELECT result FROM user_events WHERE event_id = ?", (event_id,)).fetchone()
+    return row[0] if row else None
+
+# 註冊或重新命名用戶，以單一寫入交易完成「檢查名稱是否可用」與「寫入」（compare-and-set），
+# 名稱的唯一索引不分大小寫，多個執行緒或程序同時搶同一個名稱時只有一方成功。
+# event_id 為 webhookEventId：同一事件重送時直接回傳第一次的結果，不會重複寫入。
+# 回傳 'registered'（新用戶）、'renamed'（已註冊用戶改名）或 'name_taken'（名稱已被其他用戶使用）
+def register_user(user_id, name, registered_at, event_id=None):
+    with trace_span('user_store.register'), user_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if event_id:
+            row = conn.execute("SELECT result FROM user_events WHERE event_id = ?", (event_id,)).fetchone()
+            if row:
+                conn.execute("ROLLBACK")
+                return row[0]
+
+        owner = conn.execute("SELECT user_id FROM users WHERE name_key = ?", (name.casefold(),)).fetchone()
+        if owner is not None and owner[0] != user_id:
+            result = 'name_taken'
+        else:
+            exists = conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            version = bump_user_store_version(conn)
+            conn.execute(USER_UPSERT_SQL, (user_id, name, name.casefold(), registered_at or 0, None, version))
+            result = 'renamed' if exists else 'registered'
+
+        if event_id:
+            now = time.time()
+            conn.execute(
+                "INSERT INTO user_events (event_id, user_id, result, created_at) VALUES (?, ?, ?, ?)",
+                (event_id, user_id, result, now)
+            )
+            conn.execute("DELETE FROM user_events WHERE created_at < ?", (now - USER_EVENT_TTL,))
+        conn.execute("COMMIT")
+    return result
+
+# 設定用戶標籤，回傳新的標籤；用戶不存在時回傳 None
+def set_user_tags(user_id, tags):
+    with trace_span('user_store.set_tags'), user_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if not conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+            conn.execute("ROLLBACK")
+            return None
+        version = bump_user_store_version(conn)
+        tags = list(UserDirectory._normalize_tags(tags))
+        conn.execute(
+            "UPDATE users SET tags = ?, version = ? WHERE user_id = ?",
+            (json.dumps(tags, ensure_ascii=False), version, user_id)
+        )
+        conn.execute("COMMIT")
+    return tags
+
+# 解析公告的目標客群並轉為接收者列表
+# spec 可以是標籤列表（符合任一標籤），或 {"any": [...], "all": [...], "none": [...]}
+def resolve_segment_recipients(spec):
+    if isinstance(spec, (list, tuple)):
+        spec = {'any': spec}
+    if not isinstance(spec, dict) or set(spec) - {'any', 'all', 'none'}:
+        raise ValueError(f"無效的目標客群設定: {spec!r}")
+    # 每個條件都必須是標籤字串的清單，避免 "vip" 這類字串被當成 v、i、p 三個標籤
+    for key, tags in spec.items():
+        if tags is None:
+            continue
+        if not isinstance(tags, (list, tuple)) or not all(isinstance(tag, str) and tag.strip() for tag in tags):
+            raise ValueError(f"目標客群的 {key} 必須是非空白標籤的清單: {tags!r}")
+    directory = get_user_directory()
+    user_ids = directory.resolve_segments(spec.get('any') or (), spec.get('all') or (), spec.get('none') or ())
+    return [{'user_id': user_id, 'name': directory.get_name(user_id)} for user_id in user_ids]
+
+# 寫入一批匯入的用戶；整批失敗時退回這一批並逐筆重試，找出名稱衝突的行。回傳成功筆數
+def upsert_user_batch(conn, batch, version, errors):
+    rows = [
+        (
+            record['user_id'], record['name'], record['name'].casefold(), record.get('registered_at') or 0,
+            json.dumps(list(UserDirectory._normalize_tags(record['tags'])), ensure_ascii=False) if 'tags' in record else None,
+            version
+        )
+        for _, record in batch
+    ]
+    conn.execute("SAVEPOINT user_batch")
+    try:
+        conn.executemany(USER_UPSERT_SQL, rows)
+        conn.execute("RELEASE user_batch")
+        return len(rows)
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK TO user_batch")
+
+    count = 0
+    for (line_num, record), row in zip(batch, rows):
+        try:
+            conn.execute(USER_UPSERT_SQL, row)
+            count += 1
+        except sqlite3.IntegrityError:
+            owner = conn.execute("SELECT user_id FROM users WHERE name_key = ?", (row[2],)).fetchone()
+            errors.append(f"第 {line_num} 行: 名稱 {record['name']!r} 已被 {owner[0] if owner else '其他用戶'} 使用")
+    conn.execute("RELEASE user_batch")
+    return count
+
+# 批次匯入用戶：records 逐筆產生 (行號, 紀錄)，紀錄為 {"user_id", "name", "registered_at"[, "tags"]}，
+# 或是描述格式錯誤的字串。名稱不可與其他用戶重複（不分大小寫），已存在的用戶會被更新（沒有 tags 時保留原本的標籤）。
+# 每 USER_IMPORT_BATCH_SIZE 筆寫入一次，全部在同一個交易中：只要有任何錯誤（或 dry_run）就整個退回；
+# 沒有錯誤時先備份原本的用戶資料再提交。回傳 (匯入筆數, 錯誤列表, 備份檔路徑)
+def bulk_upsert_users(records, dry_run=False):
+    backup_file = None if dry_run else backup_user_data()
+    count = 0
+    errors = []
+    with user_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        version = bump_user_store_version(conn)
+        batch = []
+        for line_num, record in records:
+            if isinstance(record, str):
+                errors.append(f"第 {line_num} 行: {record}")
+                continue
+            batch.append((line_num, record))
+            if len(batch) >= USER_IMPORT_BATCH_SIZE:
+                count += upsert_user_batch(conn, batch, version, errors)
+                batch = []
+        if batch:
+            count += upsert_user_batch(conn, batch, version, errors)
+
+        if errors or dry_run:
+            conn.execute("ROLLBACK")
+            if backup_file:
+                os.remove(backup_file)
+            return count, errors, None
+        conn.execute("COMMIT")
+    return count, errors, backup_file
 
 # 檢查用戶是否已註冊
 def is_user_registered(user_id):
-    user_data = load_user_data()
-    return user_id in user_data
+    return user_id in get_user_directory()
 
 # 獲取所有已註冊用戶的名稱列表
 def get_all_user_names():
-    user_data = load_user_data()
-    return [(user_id, info['name']) for user_id, info in user_data.items()]
+    return list(get_user_directory().items())
 
 # 根據名稱查找用戶ID
 def find_user_id_by_name(name):
-    user_data = load_user_data()
-    for user_id, info in user_data.items():
-        if info['name'].lower() == name.lower():
-            return user_id
-    return None
+    return get_user_directory().find_by_name(name)
 
 # 檢查名稱是否已存在
 def is_name_exists(name):
-    user_data = load_user_data()
-    for info in user_data.values():
-        if info['name'].lower() == name.lower():
-            return True
-    return False
+    return get_user_directory().find_by_name(name) is not None
 
-# 創建註冊提示
+# 創建註冊提示（內容固定，建立一次後重複使用）
+@functools.lru_cache(maxsize=1)
 def create_register_prompt():
     flex_content = {
         "type": "bubble",
@@ -178,105 +1139,1027 @@ def create_register_prompt():
         }
     }
     
-    return FlexMessage(alt_text="註冊提示", contents=FlexContainer.from_dict(flex_content))
+    return FlexMessage(alt_text="註冊提示", contents=flex_from_dict(flex_content))
+
+# 共用狀態資料庫的資料表
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS announcement_history (
+    message_id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    sent_at INTEGER NOT NULL,
+    archived_at INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    sent INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    archive_path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_announcement_history_sent_at ON announcement_history (sent_at);
+CREATE TABLE IF NOT EXISTS announcement_deliveries (
+    message_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (message_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_announcement_deliveries_user ON announcement_deliveries (user_id);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    name_key TEXT NOT NULL UNIQUE,
+    registered_at INTEGER NOT NULL DEFAULT 0,
+    tags TEXT,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_version ON users (version);
+CREATE TABLE IF NOT EXISTS user_store (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_events (
+    event_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_events_created_at ON user_events (created_at);
+"""
+
+# 開啟共用狀態資料庫（多個程序之間協調用）；WAL 模式與資料表只在每個程序第一次開啟時設定
+def get_state_db(check_same_thread=True):
+    global state_db_initialized
+    conn = sqlite3.connect(STATE_DB_FILE, timeout=10, isolation_level=None, check_same_thread=check_same_thread)
+    if not state_db_initialized:
+        with state_db_init_lock:
+            if not state_db_initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(STATE_DB_SCHEMA)
+                state_db_initialized = True
+    return conn
+
+# 目前程序的識別碼（fork 之後 pid 會不同，因此每次重新計算）
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{WORKER_INSTANCE_ID}"
+
+# 取得或續約租約：租約空著、已過期或本來就屬於自己時成功，並延長到期時間
+def acquire_lease(name, ttl):
+    owner = get_worker_id()
+    now = time.time()
+    conn = get_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] != owner and row[1] > now:
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+            (name, owner, now + ttl)
+        )
+        conn.execute("COMMIT")
+        if row is None or row[0] != owner:
+            app.logger.info(f"取得租約 {name}，負責者: {owner}")
+        return True
+    except sqlite3.Error as e:
+        app.logger.error(f"取得租約 {name} 失敗: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+# 主動釋放租約，讓其他程序不用等到過期就能接手
+def release_lease(name):
+    conn = get_state_db()
+    try:
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, get_worker_id()))
+    except sqlite3.Error as e:
+        app.logger.error(f"釋放租約 {name} 失敗: {str(e)}")
+    finally:
+        conn.close()
+
+# 公告接收者狀態碼（status.bin 中每位接收者一個位元組）
+STATUS_PENDING = 0
+STATUS_SENT = 1
+STATUS_FAILED = 2
+STATUS_CODES = {'pending': STATUS_PENDING, 'sent': STATUS_SENT, 'failed': STATUS_FAILED}
+STATUS_NAMES = {STATUS_PENDING: 'pending', STATUS_SENT: 'sent', STATUS_FAILED: 'failed'}
+# 這些錯誤代表接收者本身無法送達（無效或已封鎖），重試也不會成功
+PERMANENT_FAILURE_STATUSES = (400, 403, 404)
+
+# 精簡格式的公告：
+#   header.json       公告內容與接收者人數
+#   recipients.jsonl  每行一位接收者 {"user_id", "name"}
+#   status.bin        每位接收者一個位元組的發送狀態，以 mmap 直接原地更新
+class CompactAnnouncement:
+    __slots__ = ('path', 'header', 'total', '_status_file', '_status')
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json'), 'r', encoding='utf-8') as f:
+            self.header = json.load(f)
+        self.total = self.header['total']
+        self._status_file = open(os.path.join(path, 'status.bin'), 'r+b')
+        # mmap 不接受長度為 0 的檔案
+        self._status = mmap.mmap(self._status_file.fileno(), 0) if self.total else bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def message_id(self):
+        return self.header['message_id']
+
+    def status(self, index):
+        return self._status[index]
+
+    def mark(self, index, status):
+        self._status[index] = status
+
+    def count_pending(self):
+        return self._status[:].count(STATUS_PENDING)
+
+    # 依序列出尚未發送的接收者 (index, recipient)，已處理的行不會被解析
+    def iter_pending(self):
+        with open(os.path.join(self.path, 'recipients.jsonl'), 'r', encoding='utf-8') as f:
+            for index, line in enumerate(f):
+                if self._status[index] == STATUS_PENDING:
+                    recipient = json.loads(line)
+                    recipient['status'] = 'pending'
+                    yield index, recipient
+
+    # 以固定的索引區間（每 size 位一批）分批列出尚未發送的接收者 (區間起點, [(index, recipient)])
+    # 同一批的接收者一起標記狀態，因此重試時每一批的成員不變，可以沿用同一個 retry key
+    def iter_pending_batches(self, size):
+        batch = []
+        start = 0
+        for index, recipient in self.iter_pending():
+            if batch and index >= start + size:
+                yield start, batch
+                batch = []
+            if not batch:
+                start = index - index % size
+            batch.append((index, recipient))
+        if batch:
+            yield start, batch
+
+    @property
+    def multicast(self):
+        return self.header.get('delivery') == 'multicast'
+
+    # 將狀態寫回磁碟
+    def flush(self):
+        if self.total:
+            self._status.flush()
+
+    def close(self):
+        if self.total and not self._status.closed:
+            self._status.flush()
+            self._status.close()
+        self._status_file.close()
+
+# 建立精簡格式的公告：先寫入暫存資料夾，完成後再改名，避免發送端讀到寫到一半的公告
+def create_announcement(header, recipients, target_dir=None):
+    target_dir = target_dir or ANNOUNCEMENT_DIR
+    tmp_dir = target_dir.rstrip('/\\') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    total = 0
+    with open(os.path.join(tmp_dir, 'recipients.jsonl'), 'w', encoding='utf-8') as rf, \
+            open(os.path.join(tmp_dir, 'status.bin'), 'wb') as sf:
+        for recipient in recipients:
+            rf.write(json.dumps({'user_id': recipient['user_id'], 'name': recipient.get('name', '')}, ensure_ascii=False))
+            rf.write('\n')
+            sf.write(bytes((STATUS_CODES.get(recipient.get('status', 'pending'), STATUS_FAILED),)))
+            total += 1
+
+    header = {key: value for key, value in header.items() if key != 'recipients'}
+    header['total'] = total
+    with open(os.path.join(tmp_dir, 'header.json'), 'w', encoding='utf-8') as f:
+        json.dump(header, f, ensure_ascii=False, indent=4)
+
+    os.replace(tmp_dir, target_dir)
+    return target_dir
+
+# 將舊格式 announcement.json 轉換為精簡格式，成功後移除舊檔
+# 沒有 recipients 而指定 segments 時，在這裡依標籤解析出接收者，之後以 multicast 分批發送
+def convert_legacy_announcement(legacy_file=None, target_dir=None):
+    legacy_file = legacy_file or ANNOUNCEMENT_FILE
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        announcement = json.load(f)
+    recipients = announcement.get('recipients')
+    if recipients is None and 'segments' in announcement:
+        recipients = resolve_segment_recipients(announcement['segments'])
+        announcement.setdefault('delivery', 'multicast')
+        app.logger.info(f"公告目標客群 {announcement['segments']} 共 {len(recipients)} 人")
+    create_announcement(announcement, recipients, target_dir)
+    os.remove(legacy_file)
+    app.logger.info(f"已將舊格式公告轉換為精簡格式: {announcement['message_id']}")
+
+# 將精簡格式的公告還原為舊格式（單一 JSON，含 recipients 陣列），供檢視或匯出使用
+def export_legacy_announcement(path):
+    with CompactAnnouncement(path) as announcement:
+        legacy = {key: value for key, value in announcement.header.items() if key != 'total'}
+        legacy['recipients'] = []
+        with open(os.path.join(path, 'recipients.jsonl'), 'r', encoding='utf-8') as f:
+            for index, line in enumerate(f):
+                recipient = json.loads(line)
+                recipient['status'] = STATUS_NAMES[announcement.status(index)]
+                legacy['recipients'].append(recipient)
+    return legacy
+
+# 開啟目前的公告（不存在時回傳 None）；若有人放入舊格式檔案則先轉換
+def load_announcement():
+    if os.path.exists(ANNOUNCEMENT_FILE) and not os.path.exists(ANNOUNCEMENT_DIR):
+        convert_legacy_announcement()
+    if not os.path.exists(ANNOUNCEMENT_DIR):
+        return None
+    return CompactAnnouncement(ANNOUNCEMENT_DIR)
+
+# 將處理完成的公告移至歷史資料夾
+def archive_announcement(announcement):
+    announcement.close()
+    timestamp = datetime.datetime.fromtimestamp(announcement.header['sent_at']/1000).strftime('%Y%m%d_%H%M%S')
+    history_dir = os.path.join(HISTORY_FOLDER, f"announcement_{timestamp}")
+    if os.path.exists(history_dir):
+        history_dir = f"{history_dir}_{announcement.message_id}"
+
+    # 整個資料夾直接改名搬移，不需要複製
+    os.replace(announcement.path, history_dir)
+
+    # 寫入歷史索引，之後查詢統計不需要再打開每個封存檔
+    try:
+        index_announcement_history(history_dir)
+    except Exception as e:
+        app.logger.error(f"寫入公告歷史索引失敗: {str(e)}")
+    return history_dir
+
+# 讀取歷史封存（精簡格式資料夾或舊格式 JSON），回傳 (公告摘要, 接收者迭代器)
+# 接收者迭代器每次產生 (user_id, name, status)
+def read_history_archive(path):
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'header.json'), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+        with open(os.path.join(path, 'status.bin'), 'rb') as f:
+            statuses = f.read()
+
+        def iter_recipients():
+            with open(os.path.join(path, 'recipients.jsonl'), 'r', encoding='utf-8') as f:
+                for index, line in enumerate(f):
+                    recipient = json.loads(line)
+                    yield recipient['user_id'], recipient.get('name', ''), STATUS_NAMES.get(statuses[index], 'failed')
+        return header, iter_recipients()
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        announcement = json.load(f)
+    header = {key: value for key, value in announcement.items() if key != 'recipients'}
+    recipients = ((r['user_id'], r.get('name', ''), r['status']) for r in announcement['recipients'])
+    return header, recipients
+
+# 將封存的公告寫入歷史索引：一筆公告摘要，加上每位接收者一筆發送結果
+def index_announcement_history(history_path):
+    header, recipients = read_history_archive(history_path)
+    message_id = header['message_id']
+    counts = {'sent': 0, 'failed': 0, 'pending': 0}
+
+    def delivery_rows():
+        for user_id, name, status in recipients:
+            counts[status] = counts.get(status, 0) + 1
+            yield message_id, user_id, name, status
+
+    conn = get_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM announcement_deliveries WHERE message_id = ?", (message_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO announcement_deliveries (message_id, user_id, name, status) VALUES (?, ?, ?, ?)",
+            delivery_rows()
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO announcement_history"
+            " (message_id, content, sent_at, archived_at, total, sent, failed, archive_path)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (message_id, header.get('content', ''), header['sent_at'], int(time.time() * 1000),
+             sum(counts.values()), counts['sent'], counts['failed'], history_path)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# 統計期間內的公告發送結果（since_ms / until_ms 為毫秒時間戳，None 表示不限制）
+def query_history_stats(since_ms=None, until_ms=None):
+    conn = get_state_db()
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(sent), 0), COALESCE(SUM(failed), 0)"
+            " FROM announcement_history WHERE sent_at >= ? AND sent_at < ?",
+            (since_ms if since_ms is not None else 0, until_ms if until_ms is not None else 2**62)
+        ).fetchone()
+    finally:
+        conn.close()
+    return {'announcements': row[0], 'recipients': row[1], 'sent': row[2], 'failed': row[3]}
+
+# 查詢某位用戶收過哪些公告（由新到舊）
+def query_user_deliveries(user_id, limit=50):
+    conn = get_state_db()
+    try:
+        rows = conn.execute(
+            "SELECT h.message_id, h.sent_at, h.content, d.status"
+            " FROM announcement_deliveries d JOIN announcement_history h ON h.message_id = d.message_id"
+            " WHERE d.user_id = ? ORDER BY h.sent_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [{'message_id': r[0], 'sent_at': r[1], 'content': r[2], 'status': r[3]} for r in rows]
+
+# 壓縮較舊的原始封存檔，並刪除超過保留期限的封存（索引中的統計資料會保留）
+def maintain_history_archives(now=None):
+    now = now or time.time()
+    compress_before = now - HISTORY_COMPRESS_AFTER_DAYS * 86400
+    delete_before = now - HISTORY_RETENTION_DAYS * 86400 if HISTORY_RETENTION_DAYS > 0 else None
+    moved = {}
+
+    for entry in os.listdir(HISTORY_FOLDER):
+        path = os.path.join(HISTORY_FOLDER, entry)
+        mtime = os.path.getmtime(path)
+
+        if entry.endswith('.gz'):
+            if delete_before is not None and mtime < delete_before:
+                os.remove(path)
+                moved[path] = None
+                app.logger.info(f"已刪除過期的公告封存: {path}")
+        elif mtime < compress_before:
+            if os.path.isdir(path):
+                shutil.make_archive(path, 'gztar', root_dir=HISTORY_FOLDER, base_dir=entry)
+                compressed = path + '.tar.gz'
+                shutil.rmtree(path)
+            else:
+                compressed = path + '.gz'
+                with open(path, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+            # 保留原本的修改時間，讓保留期限從封存時起算
+            os.utime(compressed, (mtime, mtime))
+            moved[path] = compressed
+            app.logger.info(f"已壓縮公告封存: {compressed}")
+
+    # 更新索引中的封存路徑
+    if moved:
+        conn = get_state_db()
+        try:
+            conn.executemany(
+                "UPDATE announcement_history SET archive_path = ? WHERE archive_path = ?",
+                [(new_path, old_path) for old_path, new_path in moved.items()]
+            )
+        finally:
+            conn.close()
+    return moved
+
+# 每位接收者固定的重試金鑰：同一則公告重送給同一人時，LINE 會回傳 409 而不會重複發送
+def announcement_retry_key(announcement, user_id):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"announcement/{announcement['message_id']}/{user_id}"))
+
+# 以 multicast 發送的一批接收者共用的 retry key（以區間起點識別）
+def announcement_batch_retry_key(announcement, start):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"announcement/{announcement['message_id']}/batch/{start}"))
+
+# 公告要發送的訊息內容
+def create_announcement_messages(announcement):
+    return [
+        TextMessage(text=f"📢 系統公告：\n{announcement['content']}")
+        # StickerMessage(package_id="11537", sticker_id="52002736")  # 收到訊息貼圖
+    ]
+
+# 依剩餘的時間預算縮短單次呼叫的逾時秒數，避免一次呼叫就超過無伺服器函式的執行上限
+# deadline 為 time.monotonic() 的時間點，None 表示不限制
+def budget_request_timeout(deadline):
+    if deadline is None:
+        return LINE_REQUEST_TIMEOUT
+    remaining = max(deadline - time.monotonic(), 0.1)
+    return tuple(min(timeout, remaining) for timeout in LINE_REQUEST_TIMEOUT)
+
+# 發送公告給單一接收者，回傳新的狀態碼：
+# STATUS_SENT 已送達、STATUS_FAILED 無法送達、STATUS_PENDING 暫時失敗留待下次重試
+# deadline 不為 None 時依剩餘時間限制逾時，且不與轉發訊息合併（合併後的等待時間無法控制）
+def send_announcement_to(line_bot_api, announcement, recipient, deadline=None):
+    try:
+        # 同一接收者剛好有待發的轉發訊息時，直接併入同一次請求
+        merged = None
+        if deadline is None:
+            merged = outbound_coalescer.try_merge(recipient['user_id'], create_announcement_messages(announcement))
+        if merged is not None:
+            merged.result(timeout=OUTBOUND_SEND_TIMEOUT)
+            recipient['status'] = 'sent'
+            app.logger.info(f"成功發送公告給 {recipient['name']} ({recipient['user_id']})（與其他訊息合併）")
+            return STATUS_SENT
+
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=recipient['user_id'],
+                messages=create_announcement_messages(announcement)
+            ),
+            x_line_retry_key=announcement_retry_key(announcement, recipient['user_id']),
+            _request_timeout=budget_request_timeout(deadline)
+        )
+
+        # 更新狀態為已發送
+        consume_push_quota(1)
+        recipient['status'] = 'sent'
+        app.logger.info(f"成功發送公告給 {recipient['name']} ({recipient['user_id']})")
+        return STATUS_SENT
+    except ApiException as e:
+        if e.status == 409:
+            # 上一次已送達但尚未記錄，視為已發送
+            recipient['status'] = 'sent'
+            app.logger.info(f"公告先前已送達 {recipient['name']} ({recipient['user_id']})")
+            return STATUS_SENT
+        app.logger.error(f"發送公告給 {recipient['name']} 失敗: {str(e)}")
+        if e.status in PERMANENT_FAILURE_STATUSES:
+            recipient['status'] = 'failed'
+            return STATUS_FAILED
+        return STATUS_PENDING
+    except CircuitOpenError:
+        return STATUS_PENDING
+    except Exception as e:
+        app.logger.error(f"發送公告給 {recipient['name']} 失敗: {str(e)}")
+        return STATUS_PENDING
+
+# 以 multicast 發送公告給一批接收者（最多 MULTICAST_MAX_RECIPIENTS 位），回傳整批的新狀態碼
+def send_announcement_batch(line_bot_api, announcement, start, batch, deadline=None):
+    try:
+        line_bot_api.multicast(
+            MulticastRequest(
+                to=[recipient['user_id'] for _, recipient in batch],
+                messages=create_announcement_messages(announcement)
+            ),
+            x_line_retry_key=announcement_batch_retry_key(announcement, start),
+            _request_timeout=budget_request_timeout(deadline)
+        )
+        consume_push_quota(len(batch))
+        record_metric('announcement_multicast_requests')
+        app.logger.info(f"成功以 multicast 發送公告給 {len(batch)} 人（第 {start} 位起）")
+        return STATUS_SENT
+    except ApiException as e:
+        if e.status == 409:
+            app.logger.info(f"公告先前已送達第 {start} 位起的 {len(batch)} 人")
+            return STATUS_SENT
+        app.logger.error(f"以 multicast 發送公告失敗（第 {start} 位起）: {str(e)}")
+        if e.status in PERMANENT_FAILURE_STATUSES:
+            return STATUS_FAILED
+        return STATUS_PENDING
+    except CircuitOpenError:
+        return STATUS_PENDING
+    except Exception as e:
+        app.logger.error(f"以 multicast 發送公告失敗（第 {start} 位起）: {str(e)}")
+        return STATUS_PENDING
 
 # 處理公告訊息
-def process_announcements():
-    # 檢查是否存在公告檔案
-    if os.path.exists(ANNOUNCEMENT_FILE):
+# time_budget 為本次最多可使用的秒數（None 表示不限制），回傳本次處理結果摘要
+def process_announcements(time_budget=None):
+    with start_trace('process_announcements', time_budget=time_budget):
+        return _process_announcements(time_budget)
+
+def _process_announcements(time_budget=None):
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    # 同一個程序內同時只允許一次處理，避免背景任務與排程端點重複發送
+    if not announcement_lock.acquire(blocking=False):
+        return {'status': 'busy'}
+
+    try:
+        # 跨程序只允許持有租約的一方發送，其他程序待命
+        if not acquire_lease(ANNOUNCEMENT_LEASE, ANNOUNCEMENT_LEASE_TTL):
+            return {'status': 'standby'}
+
+        # 檢查是否存在公告
+        with trace_span('load_announcement'):
+            announcement = load_announcement()
+        if announcement is None:
+            return {'status': 'idle'}
+
         try:
-            # 讀取公告檔案
-            with open(ANNOUNCEMENT_FILE, 'r', encoding='utf-8') as f:
-                announcement = json.load(f)
-            
-            app.logger.info(f"找到公告檔案，開始處理: {announcement['message_id']}")
-            
-            # 檢查是否所有接收者都已處理完成
-            all_processed = True
-            for recipient in announcement['recipients']:
-                if recipient['status'] == 'pending':
-                    all_processed = False
-                    break
-            
-            # 如果所有接收者都已處理，直接移動檔案到歷史資料夾
-            if all_processed:
-                timestamp = datetime.datetime.fromtimestamp(announcement['sent_at']/1000).strftime('%Y%m%d_%H%M%S')
-                history_file = os.path.join(HISTORY_FOLDER, f"announcement_{timestamp}.json")
-                
-                # 複製到歷史資料夾
-                shutil.copy2(ANNOUNCEMENT_FILE, history_file)
-                
-                # 刪除原始檔案
-                os.remove(ANNOUNCEMENT_FILE)
-                
-                app.logger.info(f"所有接收者已處理，公告檔案已移至歷史資料夾: {history_file}")
-                return
-            
+            app.logger.info(f"找到公告，開始處理: {announcement.message_id}")
+
+            result = {
+                'status': 'in_progress',
+                'message_id': announcement.message_id,
+                'sent': 0,
+                'failed': 0,
+                'deferred': 0,
+                'remaining': announcement.count_pending()
+            }
+
+            # 如果所有接收者都已處理，直接移動到歷史資料夾
+            if result['remaining'] == 0:
+                history_dir = archive_announcement(announcement)
+                app.logger.info(f"所有接收者已處理，公告已移至歷史資料夾: {history_dir}")
+                result['status'] = 'done'
+                return result
+
+            # 依目標客群建立的公告每批最多 MULTICAST_MAX_RECIPIENTS 人一次 multicast，其他公告逐一 push
+            if announcement.multicast:
+                breaker = circuit_breakers['multicast']
+                batches = announcement.iter_pending_batches(MULTICAST_MAX_RECIPIENTS)
+            else:
+                breaker = circuit_breakers['push']
+                batches = ((index, [(index, recipient)]) for index, recipient in announcement.iter_pending())
+
             # 使用 LINE API 發送訊息
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                
-                # 遍歷所有接收者
-                for recipient in announcement['recipients']:
-                    if recipient['status'] == 'pending':
-                        try:
-                            # 發送訊息
-                            line_bot_api.push_message(
-                                PushMessageRequest(
-                                    to=recipient['user_id'],
-                                    messages=[
-                                        TextMessage(text=f"📢 系統公告：\n{announcement['content']}")
-                                        # StickerMessage(package_id="11537", sticker_id="52002736")  # 收到訊息貼圖
-                                    ]
-                                )
-                            )
-                            
-                            # 更新狀態為已發送
-                            recipient['status'] = 'sent'
-                            app.logger.info(f"成功發送公告給 {recipient['name']} ({recipient['user_id']})")
-                        except Exception as e:
-                            app.logger.error(f"發送公告給 {recipient['name']} 失敗: {str(e)}")
-                
-                # 保存更新後的公告（包含已更新的狀態）
-                with open(ANNOUNCEMENT_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(announcement, f, ensure_ascii=False, indent=4)
-                
-                # 檢查是否所有接收者都已處理完成
-                all_processed = True
-                for recipient in announcement['recipients']:
-                    if recipient['status'] == 'pending':
-                        all_processed = False
+            with shared_api_client() as api_client:
+                line_bot_api = GuardedMessagingApi(api_client)
+
+                unsaved = 0
+                lease_renewed_at = time.monotonic()
+                lease_lost = False
+                # 遍歷所有待發送的接收者
+                for start, batch in batches:
+                    # 時間預算用完就先停下，剩下的留給下一次呼叫
+                    if deadline is not None and time.monotonic() >= deadline:
                         break
-                
-                # 如果所有接收者都已處理，移動檔案到歷史資料夾
-                if all_processed:
-                    timestamp = datetime.datetime.fromtimestamp(announcement['sent_at']/1000).strftime('%Y%m%d_%H%M%S')
-                    history_file = os.path.join(HISTORY_FOLDER, f"announcement_{timestamp}.json")
-                    
-                    # 複製到歷史資料夾
-                    shutil.copy2(ANNOUNCEMENT_FILE, history_file)
-                    
-                    # 刪除原始檔案
-                    os.remove(ANNOUNCEMENT_FILE)
-                    
-                    app.logger.info(f"公告處理完成，已移至歷史資料夾: {history_file}")
-                
-        except Exception as e:
-            app.logger.error(f"處理公告檔案時發生錯誤: {str(e)}")
+                    # 依經過時間續約，租約被其他程序取得就立刻停止
+                    if time.monotonic() - lease_renewed_at >= ANNOUNCEMENT_LEASE_RENEW_INTERVAL:
+                        if not acquire_lease(ANNOUNCEMENT_LEASE, ANNOUNCEMENT_LEASE_TTL):
+                            app.logger.warning("公告發送租約已被其他程序取得，停止本次發送")
+                            lease_lost = True
+                            break
+                        lease_renewed_at = time.monotonic()
+                    # LINE API 故障時暫停發送，等斷路器恢復再繼續，不要對每位接收者都白試一次
+                    if breaker.is_open():
+                        result['status'] = 'paused'
+                        result['retry_after'] = breaker.retry_after()
+                        app.logger.warning("LINE API 暫時無法使用，暫停發送公告")
+                        break
+
+                    # 發送訊息，有結果時直接更新狀態位元組
+                    if announcement.multicast:
+                        status = send_announcement_batch(line_bot_api, announcement.header, start, batch, deadline)
+                    else:
+                        status = send_announcement_to(line_bot_api, announcement.header, batch[0][1], deadline)
+                    if status != STATUS_PENDING:
+                        for index, _ in batch:
+                            announcement.mark(index, status)
+                    # 暫時失敗的接收者仍在 remaining 中，另外計為 deferred，不算進 failed
+                    if status == STATUS_SENT:
+                        result['sent'] += len(batch)
+                    elif status == STATUS_FAILED:
+                        result['failed'] += len(batch)
+                    else:
+                        result['deferred'] += len(batch)
+
+                    # 定期保存進度，即使中途被終止也不會重複發送太多
+                    unsaved += 1
+                    if unsaved >= ANNOUNCEMENT_CHECKPOINT_EVERY:
+                        announcement.flush()
+                        unsaved = 0
+
+                # 保存更新後的狀態
+                announcement.flush()
+
+            # 檢查是否所有接收者都已處理完成
+            result['remaining'] = announcement.count_pending()
+
+            # 租約已經不屬於自己，交給新的持有者處理（包括移到歷史資料夾）
+            if lease_lost:
+                result['status'] = 'standby'
+                return result
+
+            # 如果所有接收者都已處理，移動到歷史資料夾
+            if result['remaining'] == 0:
+                history_dir = archive_announcement(announcement)
+                app.logger.info(f"公告處理完成，已移至歷史資料夾: {history_dir}")
+                result['status'] = 'done'
+
+            return result
+        finally:
+            announcement.close()
+
+    except Exception as e:
+        app.logger.error(f"處理公告檔案時發生錯誤: {str(e)}")
+        return {'status': 'error', 'error': str(e)}
+    finally:
+        announcement_lock.release()
 
 # 背景任務：檢查公告檔案
 def announcement_checker():
+    last_maintenance = 0
     while True:
         try:
             # 檢查並處理公告
-            process_announcements()
-            # 每5秒檢查一次
-            time.sleep(5)
+            result = process_announcements()
+            # 只由負責發送公告的程序定期整理歷史封存
+            if result['status'] not in ('standby', 'busy') and time.time() - last_maintenance >= HISTORY_MAINTENANCE_INTERVAL:
+                last_maintenance = time.time()
+                maintain_history_archives()
+            # 每5秒檢查一次；LINE API 故障而暫停時，等到斷路器可以再試探為止
+            time.sleep(max(5, result.get('retry_after', 0)))
         except Exception as e:
             app.logger.error(f"公告檢查任務發生錯誤: {str(e)}")
             time.sleep(10)  # 發生錯誤時，等待稍長時間再重試
 
-# 創建功能選單
+# 啟動公告背景任務；多個程序都可以啟動，實際只有持有租約的一方會發送
+def start_announcement_checker():
+    announcement_thread = threading.Thread(target=announcement_checker)
+    announcement_thread.daemon = True  # 設為守護線程，主程序結束時自動終止
+    announcement_thread.start()
+    # 正常結束時釋放租約，讓其他程序立即接手
+    atexit.register(release_lease, ANNOUNCEMENT_LEASE)
+    return announcement_thread
+
+# 外送訊息合併器：短時間內發給同一個接收者的 push 合併成一次請求（最多 5 則訊息）
+# 每則訊息最多等待 window 秒就會送出，呼叫端可透過回傳的 Future 取得發送結果
+class OutboundCoalescer:
+    def __init__(self, window, max_messages=PUSH_MAX_MESSAGES, send_threads=4):
+        self.window = window
+        self.max_messages = max_messages
+        self.send_threads = send_threads
+        self._pending = {}  # to -> {'messages', 'futures', 'deadline'}
+        self._condition = threading.Condition()
+        self._flusher = None
+        self._executor = None
+
+    # 加入一筆要發送的訊息，回傳 Future（結果為實際的發送方式 'reply' 或 'push'，失敗時為例外）
+    def submit(self, to, messages):
+        if len(messages) > self.max_messages:
+            raise ValueError(f"一次最多只能發送 {self.max_messages} 則訊息")
+
+        future = Future()
+        record_metric('outbound_messages_submitted')
+
+        # 不合併時直接發送
+        if self.window <= 0:
+            self._send(to, list(messages), [future], 1)
+            return future
+
+        with self._condition:
+            batch = self._pending.get(to)
+            if batch is not None and len(batch['messages']) + len(messages) > self.max_messages:
+                # 放不下了，先把目前這批送出
+                self._dispatch(self._pending.pop(to))
+                batch = None
+            if batch is None:
+                batch = {'to': to, 'messages': [], 'futures': [], 'deadline': time.monotonic() + self.window}
+                self._pending[to] = batch
+            batch['messages'].extend(messages)
+            batch['futures'].append(future)
+
+            # 已經滿了就立刻送出，不用等到時間到
+            if len(batch['messages']) >= self.max_messages:
+                self._dispatch(self._pending.pop(to))
+            self._ensure_flusher()
+            self._condition.notify()
+        return future
+
+    # 只在已有同一接收者的待發批次且放得下時合併，否則回傳 None（公告用，避免額外等待）
+    def try_merge(self, to, messages):
+        with self._condition:
+            batch = self._pending.get(to)
+            if batch is None or len(batch['messages']) + len(messages) > self.max_messages:
+                return None
+            future = Future()
+            record_metric('outbound_messages_submitted')
+            batch['messages'].extend(messages)
+            batch['futures'].append(future)
+            if len(batch['messages']) >= self.max_messages:
+                self._dispatch(self._pending.pop(to))
+            return future
+
+    def _ensure_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    # 背景執行緒：把到期的批次送出
+    def _flush_loop(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                for to in [to for to, batch in self._pending.items() if batch['deadline'] <= now]:
+                    self._dispatch(self._pending.pop(to))
+                if self._pending:
+                    self._condition.wait(min(batch['deadline'] for batch in self._pending.values()) - now)
+                else:
+                    self._condition.wait()
+
+    # 交給發送執行緒池送出一個批次（呼叫時需持有鎖）
+    def _dispatch(self, batch):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.send_threads, thread_name_prefix='outbound')
+        self._executor.submit(self._send, batch['to'], batch['messages'], batch['futures'], len(batch['futures']))
+
+    # 接收者剛好有還沒用掉的回覆權杖時改用 reply（不計入訊息額度），失敗（例如權杖已過期）再改用 push
+    def _send(self, to, messages, futures, merged):
+        line_bot_api = GuardedMessagingApi(get_api_client())
+        claimed = reply_token_cache.claim(to)
+        if claimed is not None:
+            reply_token, expires_at = claimed
+            try:
+                line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=messages))
+                record_metric('outbound_reply_deliveries')
+                record_metric('push_quota_saved')
+                record_metric('outbound_push_requests_saved', merged)
+                for future in futures:
+                    future.set_result('reply')
+                return
+            except CircuitOpenError as e:
+                # 斷路器擋下時權杖根本沒送出，放回去留給之後的訊息使用
+                reply_token_cache.offer(to, reply_token, expires_at)
+                record_metric('outbound_reply_fallbacks')
+                app.logger.warning(f"回覆暫時無法使用，改用 push 發送給 {to}: {str(e)}")
+            except Exception as e:
+                record_metric('outbound_reply_fallbacks')
+                app.logger.warning(f"以回覆權杖發送給 {to} 失敗，改用 push: {str(e)}")
+
+        try:
+            line_bot_api.push_message(PushMessageRequest(to=to, messages=messages))
+            consume_push_quota(1)
+            record_metric('outbound_push_requests')
+            # 合併了幾筆就省下幾次請求
+            record_metric('outbound_push_requests_saved', merged - 1)
+            for future in futures:
+                future.set_result('push')
+        except Exception as e:
+            record_metric('outbound_push_requests')
+            record_metric('outbound_push_failures')
+            for future in futures:
+                future.set_exception(e)
+
+outbound_coalescer = OutboundCoalescer(OUTBOUND_COALESCE_WINDOW)
+
+# 尚未使用的回覆權杖：每位用戶只保留最新的一個，取用後即移除（每個權杖只能用一次）
+class ReplyTokenCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._tokens = {}  # user_id -> (reply_token, expires_at)
+        self._lock = threading.Lock()
+
+    # 保留用戶的回覆權杖；expires_at 用於放回還沒用掉的權杖，保持原本的期限
+    def offer(self, user_id, reply_token, expires_at=None):
+        now = time.monotonic()
+        with self._lock:
+            self._tokens[user_id] = (reply_token, expires_at or now + self.ttl)
+            # 順便清掉過期的權杖，避免累積
+            if len(self._tokens) > 1000:
+                for expired in [uid for uid, (_, expires_at) in self._tokens.items() if expires_at <= now]:
+                    del self._tokens[expired]
+
+    # 取出用戶還有效的回覆權杖與期限 (reply_token, expires_at)（沒有時回傳 None）
+    def claim(self, user_id):
+        with self._lock:
+            entry = self._tokens.pop(user_id, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry
+
+reply_token_cache = ReplyTokenCache(REPLY_TOKEN_TTL)
+
+# 目前處理中的事件的回覆權杖與是否已使用 {'token', 'used'}
+current_event_reply = contextvars.ContextVar('current_event_reply', default=None)
+
+# 事件處理函式的裝飾器：處理完仍沒有回覆的事件，把回覆權杖留給之後發給該用戶的訊息使用
+# 只保留一對一聊天的權杖；群組或聊天室的權杖會回覆到群組裡，不能拿來送私人訊息
+def offers_unused_reply_token(handler):
+    @functools.wraps(handler)
+    def wrapper(event):
+        reply_token = getattr(event, 'reply_token', None)
+        # 部分事件（例如 activated、module 事件）沒有 source
+        source = getattr(event, 'source', None)
+        user_id = getattr(source, 'user_id', None) if source is not None and source.type == 'user' else None
+        event_reply = {'token': reply_token, 'used': False}
+        token = current_event_reply.set(event_reply)
+        try:
+            return handler(event)
+        finally:
+            current_event_reply.reset(token)
+            if reply_token and user_id and not event_reply['used']:
+                reply_token_cache.offer(user_id, reply_token)
+    return wrapper
+
+# 權杖桶：每秒補充 rate 個權杖，最多累積 capacity 個
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'lock')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # 嘗試取用 n 個權杖，成功回傳 0，失敗回傳還需要等待的秒數
+    def try_consume(self, n=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            if n > self.capacity or self.rate <= 0:
+                return float('inf')
+            return (n - self.tokens) / self.rate
+
+    # 取用失敗時把權杖還回去
+    def refund(self, n=1):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+# 每位發送者各自的權杖桶（計算轉發次數）與全體共用的權杖桶（計算發出的訊息數）
+forward_user_buckets = {}
+forward_user_buckets_lock = threading.Lock()
+forward_global_bucket = TokenBucket(FORWARD_GLOBAL_RATE_PER_MINUTE / 60, FORWARD_GLOBAL_BURST)
+
+def get_forward_user_bucket(user_id):
+    with forward_user_buckets_lock:
+        bucket = forward_user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(FORWARD_USER_RATE_PER_MINUTE / 60, FORWARD_USER_BURST)
+            forward_user_buckets[user_id] = bucket
+        return bucket
+
+# LINE 訊息額度快取：{'remaining': 剩餘則數或 None（無上限／未知）, 'fetched_at': 時間}
+push_quota_cache = {'remaining': None, 'fetched_at': 0, 'consumed_during_fetch': None}
+push_quota_lock = threading.Lock()
+
+# 查詢本月剩餘的訊息額度（快取 QUOTA_CACHE_TTL 秒），None 表示沒有上限或暫時無法取得
+# 查詢 LINE API 時不持有鎖（最久可能十幾秒），其他執行緒照常使用舊的快取值並扣除額度；
+# 查詢期間扣除的則數會從新的結果中再扣掉一次
+def get_push_quota_remaining():
+    with push_quota_lock:
+        if time.monotonic() - push_quota_cache['fetched_at'] < QUOTA_CACHE_TTL:
+            return push_quota_cache['remaining']
+        # 由這個執行緒負責查詢，其他執行緒在查詢完成前繼續使用舊值
+        push_quota_cache['fetched_at'] = time.monotonic()
+        push_quota_cache['consumed_during_fetch'] = 0
+
+    try:
+        with shared_api_client() as api_client:
+            line_bot_api = GuardedMessagingApi(api_client)
+            quota = line_bot_api.get_message_quota(_request_timeout=LINE_REQUEST_TIMEOUT)
+            if quota.type == 'limited':
+                usage = line_bot_api.get_message_quota_consumption(_request_timeout=LINE_REQUEST_TIMEOUT)
+                remaining = quota.value - usage.total_usage
+            else:
+                remaining = None
+    except Exception as e:
+        app.logger.error(f"查詢訊息額度失敗: {str(e)}")
+        remaining = None
+
+    with push_quota_lock:
+        if remaining is not None:
+            remaining -= push_quota_cache['consumed_during_fetch'] or 0
+        push_quota_cache['remaining'] = remaining
+        push_quota_cache['consumed_during_fetch'] = None
+        return remaining
+
+# 發出訊息後先在快取中扣除，不用等下次查詢
+def consume_push_quota(n):
+    with push_quota_lock:
+        if push_quota_cache['remaining'] is not None:
+            push_quota_cache['remaining'] -= n
+        if push_quota_cache['consumed_during_fetch'] is not None:
+            push_quota_cache['consumed_during_fetch'] += n
+
+# 目前公告尚未發送的人數：只讀取 status.bin，不會轉換舊格式公告或開啟 mmap
+# （轉換只由持有租約的發送端進行）；沒有公告時回傳 0
+def count_pending_announcement_recipients():
+    try:
+        with open(os.path.join(ANNOUNCEMENT_DIR, 'status.bin'), 'rb') as f:
+            return f.read().count(STATUS_PENDING)
+    except FileNotFoundError:
+        return 0
+
+# 額度不足時要保留給公告的則數：至少 QUOTA_LOW_WATERMARK，且不少於目前公告尚未發送的人數
+def get_announcement_quota_reserve():
+    reserve = QUOTA_LOW_WATERMARK
+    try:
+        reserve = max(reserve, count_pending_announcement_recipients())
+    except OSError as e:
+        app.logger.error(f"讀取公告待發送人數失敗: {str(e)}")
+    return reserve
+
+# 檢查這次轉發是否允許，允許時回傳 None，否則回傳要告訴用戶的原因
+# cost 為這次轉發會用掉的訊息則數（收件人數）
+def check_forward_allowed(user_id, cost):
+    wait = get_forward_user_bucket(user_id).try_consume()
+    if wait:
+        record_metric('forward_rate_limited')
+        if wait == float('inf'):
+            return "目前暫停發送訊息，請稍後再試。"
+        return f"您發送得太頻繁了，請在 {math.ceil(wait)} 秒後再輸入一次訊息，或輸入 'cancel' 取消。"
+
+    wait = forward_global_bucket.try_consume(cost)
+    if wait:
+        get_forward_user_bucket(user_id).refund()
+        record_metric('forward_rate_limited')
+        if wait == float('inf'):
+            return f"一次最多只能發送給 {int(FORWARD_GLOBAL_BURST)} 人，請減少收件人後再試。"
+        return f"目前發送訊息的人太多了，請在 {math.ceil(wait)} 秒後再輸入一次訊息，或輸入 'cancel' 取消。"
+
+    # 額度快用完時，保留給系統公告
+    remaining = get_push_quota_remaining()
+    if remaining is not None and remaining - cost < get_announcement_quota_reserve():
+        get_forward_user_bucket(user_id).refund()
+        forward_global_bucket.refund(cost)
+        record_metric('forward_quota_rejected')
+        return "本月的訊息額度即將用完，目前優先保留給系統公告，暫時無法轉發訊息。"
+    return None
+
+# 解析用戶輸入的收件人選擇：單一編號、多個編號（1,3,5）、範圍（2-4）或 all／全部
+# 編號不是數字時拋出 ValueError，超出範圍時回傳空列表
+def parse_recipient_selection(text, recipient_list):
+    text = text.strip()
+    if text.lower() == "all" or text == "全部":
+        return list(recipient_list)
+
+    indexes = []
+    for part in re.split(r"[,，、\s]+", text):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+            # 先檢查範圍再展開，避免輸入 1-999999999 之類的範圍佔用大量記憶體
+            if not 1 <= start <= end <= len(recipient_list):
+                return []
+            indexes.extend(range(start, end + 1))
+        else:
+            indexes.append(int(part))
+
+    if not indexes or any(not 1 <= i <= len(recipient_list) for i in indexes):
+        return []
+    # 去除重複的編號，保留輸入順序
+    return [recipient_list[i - 1] for i in dict.fromkeys(indexes)]
+
+# 顯示收件人名稱，人數太多時只列出前幾位
+def format_recipient_names(names, limit=FORWARD_NAME_DISPLAY_LIMIT):
+    if len(names) <= limit:
+        return "、".join(names)
+    return "、".join(names[:limit]) + f" 等 {len(names)} 人"
+
+# 記錄已選擇的收件人並進入輸入訊息階段，回傳要詢問用戶的文字
+def select_recipients(user_id, recipients):
+    message_forwarding[user_id]['recipients'] = recipients
+    message_forwarding[user_id]['stage'] = 'waiting_for_message'
+    if len(recipients) == 1:
+        return f"請輸入您要發送給 {recipients[0][1]} 的訊息："
+    names = format_recipient_names([name for _, name in recipients])
+    return f"請輸入您要發送給 {len(recipients)} 位用戶（{names}）的訊息："
+
+# 將訊息轉發給多位收件人：單一收件人透過合併器 push，多位收件人每 500 人一次 multicast
+# 回傳 (成功的收件人名稱列表, [(失敗的收件人名稱, 錯誤訊息)])
+def forward_message(line_bot_api, recipients, messages):
+    delivered = []
+    failed = []
+
+    if len(recipients) == 1:
+        recipient_id, recipient_name = recipients[0]
+        try:
+            with trace_span('outbound.push', merged_window=OUTBOUND_COALESCE_WINDOW):
+                outbound_coalescer.submit(recipient_id, messages).result(timeout=OUTBOUND_SEND_TIMEOUT)
+            delivered.append(recipient_name)
+        except Exception as e:
+            app.logger.error(f"發送訊息錯誤: {str(e)}")
+            failed.append((recipient_name, str(e)))
+        return delivered, failed
+
+    for start in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+        batch = recipients[start:start + MULTICAST_MAX_RECIPIENTS]
+        try:
+            line_bot_api.multicast(MulticastRequest(to=[uid for uid, _ in batch], messages=messages))
+            consume_push_quota(len(batch))
+            delivered.extend(name for _, name in batch)
+        except Exception as e:
+            app.logger.error(f"群發訊息錯誤: {str(e)}")
+            failed.extend((name, str(e)) for _, name in batch)
+    return delivered, failed
+
+# 整理轉發結果，一次回覆給發送者
+def create_forward_report(delivered, failed):
+    if not failed:
+        return f"成功發送給 {format_recipient_names(delivered)}   (*´з｀*) "
+    return (
+        f"成功發送給 {len(delivered)} 人：{format_recipient_names(delivered)}\n"
+        f"發送失敗 {len(failed)} 人：{format_recipient_names([name for name, _ in failed])}\n"
+        f"錯誤原因：{failed[0][1]}"
+    )
+
+# 創建功能選單（依用戶名稱快取，不用每次重新驗證 Flex 內容）
+@functools.lru_cache(maxsize=FLEX_CACHE_SIZE)
 def create_function_menu(user_name):
     flex_content = {
         "type": "bubble",
@@ -332,7 +2215,7 @@ def create_function_menu(user_name):
         }
     }
     
-    return FlexMessage(alt_text="功能選單", contents=FlexContainer.from_dict(flex_content))
+    return FlexMessage(alt_text="功能選單", contents=flex_from_dict(flex_content))
 
 
 
@@ -349,26 +2232,147 @@ def callback():
 
     # 處理 webhook 主體
     try:
-        line_handler.handle(body, signature)
+        with profiler.track_request():
+            line_handler.handle(body, signature)
     except InvalidSignatureError:
         app.logger.error("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
 
     return 'OK'
 
+# 公告排程端點：在無伺服器環境下由 Cron 定期呼叫，每次在時間預算內盡量發送
+@app.route("/tasks/announcements", methods=['GET', 'POST'])
+def announcement_task():
+    if not CRON_SECRET or request.headers.get('Authorization') != f"Bearer {CRON_SECRET}":
+        abort(401)
+
+    time_budget = request.args.get('budget', type=float) or ANNOUNCEMENT_TIME_BUDGET
+    result = process_announcements(time_budget=min(time_budget, ANNOUNCEMENT_TIME_BUDGET))
+    status_code = 500 if result['status'] == 'error' else 200
+    return jsonify(result), status_code
+
+# 檢查管理用端點的驗證密鑰
+def is_admin_request():
+    return bool(ADMIN_TOKEN) and request.headers.get('Authorization') == f"Bearer {ADMIN_TOKEN}"
+
+# 將 YYYY-MM-DD 日期參數轉為毫秒時間戳
+def parse_date_ms(value):
+    if not value:
+        return None
+    return int(datetime.datetime.strptime(value, '%Y-%m-%d').timestamp() * 1000)
+
+# 查詢統計數據
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    if not is_admin_request():
+        abort(401)
+    return jsonify({
+        'counters': get_metrics_snapshot(),
+        'push_quota_remaining': push_quota_cache['remaining'],
+        'circuit_breakers': {name: breaker.snapshot() for name, breaker in circuit_breakers.items()}
+    })
+
+# 查詢期間內的公告發送統計，例如 /admin/history/stats?since=2026-09-01&until=2026-10-01
+@app.route("/admin/history/stats", methods=['GET'])
+def history_stats():
+    if not is_admin_request():
+        abort(401)
+    try:
+        since_ms = parse_date_ms(request.args.get('since'))
+        until_ms = parse_date_ms(request.args.get('until'))
+    except ValueError:
+        abort(400)
+    return jsonify(query_history_stats(since_ms, until_ms))
+
+# 查詢某位用戶收過哪些公告
+@app.route("/admin/history/users/<user_id>", methods=['GET'])
+def history_user_deliveries(user_id):
+    if not is_admin_request():
+        abort(401)
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(query_user_deliveries(user_id, limit))
+
+# 開始效能分析，例如 POST /admin/profile?seconds=30 或 ?requests=200；GET 查詢目前狀態
+# 加上 stop=1 可提前結束
+@app.route("/admin/profile", methods=['GET', 'POST'])
+def profile_endpoint():
+    if not is_admin_request():
+        abort(401)
+    if request.method == 'POST':
+        if request.args.get('stop'):
+            profiler.stop()
+        else:
+            seconds = request.args.get('seconds', type=float)
+            max_requests = request.args.get('requests', type=int)
+            if not profiler.start(duration=seconds, max_requests=max_requests):
+                return jsonify(profiler.snapshot()), 409
+    return jsonify(profiler.snapshot())
+
+# 收到 SIGUSR2 時切換效能分析：未在分析就開始 PROFILE_SIGNAL_SECONDS 秒，分析中則提前結束
+def toggle_profiler():
+    if profiler.running:
+        profiler.stop()
+    else:
+        profiler.start(duration=PROFILE_SIGNAL_SECONDS)
+
+# 訊號處理函式在主執行緒中執行，主執行緒可能正持有 profiler 的鎖（例如 gunicorn sync worker 處理請求中），
+# 因此交給另一個執行緒去取鎖，避免死結
+def handle_profile_signal(signum, frame):
+    threading.Thread(target=toggle_profiler, daemon=True).start()
+
+# 只有主執行緒能註冊訊號；Windows 沒有 SIGUSR2
+def install_profile_signal():
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+    try:
+        signal.signal(signal.SIGUSR2, handle_profile_signal)
+    except ValueError:
+        app.logger.warning("非主執行緒，無法註冊效能分析訊號")
+
+install_profile_signal()
+
+# 查詢各標籤的人數
+@app.route("/admin/segments", methods=['GET'])
+def segment_sizes():
+    if not is_admin_request():
+        abort(401)
+    return jsonify(get_user_directory().segment_sizes())
+
+# 設定用戶標籤，例如 PUT /admin/users/<user_id>/tags，內容 {"tags": ["vip", "taipei"]}
+@app.route("/admin/users/<user_id>/tags", methods=['PUT'])
+def update_user_tags(user_id):
+    if not is_admin_request():
+        abort(401)
+    tags = (request.get_json(silent=True) or {}).get('tags')
+    if not isinstance(tags, list) or not all(isinstance(tag, str) and tag.strip() for tag in tags):
+        abort(400)
+    tags = set_user_tags(user_id, [tag.strip() for tag in tags])
+    if tags is None:
+        abort(404)
+    return jsonify({'user_id': user_id, 'tags': list(tags)})
+
+# 其他沒有專用處理函式的事件（例如貼圖、圖片訊息）：不回覆，只保留回覆權杖
+@line_handler.default()
+@traced_event
+@offers_unused_reply_token
+def handle_other_event(event):
+    pass
+
 # 處理加入事件
 @line_handler.add(FollowEvent)
+@traced_event
+@offers_unused_reply_token
 def handle_follow(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    with shared_api_client() as api_client:
+        line_bot_api = GuardedMessagingApi(api_client)
         user_id = event.source.user_id
         
-        # 載入現有用戶資料
-        user_data = load_user_data()
+        # 取得用戶目錄
+        directory = get_user_directory()
         
         # 檢查用戶是否已經註冊
-        if user_id in user_data:
-            welcome_message = f"歡迎回來，{user_data[user_id]['name']}！"
+        if user_id in directory:
+            welcome_message = f"歡迎回來，{directory.get_name(user_id)}！"
             
             # 回覆歡迎訊息和貼圖，並顯示功能選單
             line_bot_api.reply_message(
@@ -401,16 +2405,24 @@ def handle_follow(event):
 
 # 處理文字訊息
 @line_handler.add(MessageEvent, message=TextMessageContent)
+@traced_event
+@offers_unused_reply_token
 def handle_message(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    with shared_api_client() as api_client:
+        line_bot_api = GuardedMessagingApi(api_client)
         user_id = event.source.user_id
         text = event.message.text
         
+        # LINE 重送的事件若先前已處理過註冊，沿用第一次的結果，不要當成一般訊息處理
+        previous_result = None
+        if event.delivery_context.is_redelivery:
+            previous_result = get_user_event_result(event.webhook_event_id)
+
         # 檢查用戶是否在註冊流程中
-        if user_id in user_states and user_states[user_id] == "waiting_for_name":
-            # 檢查名稱是否已存在
-            if is_name_exists(text):
+        if previous_result is not None or user_states.get(user_id) == "waiting_for_name":
+            # 檢查名稱並儲存用戶名稱與註冊時間（同一個交易中完成）
+            result = previous_result or register_user(user_id, text, event.timestamp, event_id=event.webhook_event_id)
+            if result == 'name_taken':
                 # 名稱已存在，請用戶重新輸入
                 try:
                     line_bot_api.reply_message(
@@ -426,20 +2438,8 @@ def handle_message(event):
                     app.logger.error(f"回覆訊息錯誤: {str(e)}")
                 return
             
-            # 載入現有用戶資料
-            user_data = load_user_data()
-            
-            # 儲存用戶名稱
-            user_data[user_id] = {
-                "name": text,
-                "registered_at": event.timestamp  # 可選：記錄註冊時間
-            }
-            
-            # 儲存更新後的用戶資料
-            save_user_data(user_data)
-            
             # 清除用戶狀態
-            del user_states[user_id]
+            user_states.pop(user_id, None)
             
             # 回覆確認訊息和貼圖，並顯示功能選單
             try:
@@ -462,10 +2462,6 @@ def handle_message(event):
             if text.lower() == "cancel" or text == "取消操作":
                 del message_forwarding[user_id]
                 try:
-                    # 載入用戶資料以獲取名稱
-                    user_data = load_user_data()
-                    user_name = user_data[user_id]['name']
-                    
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -481,26 +2477,18 @@ def handle_message(event):
     
             # 檢查當前階段
             if message_forwarding[user_id]['stage'] == 'waiting_for_recipient':
-                # 用戶正在選擇接收者
+                # 用戶正在選擇接收者（可輸入單一編號、多個編號如 1,3,5、範圍如 2-4，或 all 全部）
                 try:
-                    # 嘗試將輸入解析為數字
-                    recipient_index = int(text.strip()) - 1
                     recipient_list = message_forwarding[user_id]['recipient_list']
+                    selected = parse_recipient_selection(text, recipient_list)
                     
-                    # 檢查索引是否有效
-                    if 0 <= recipient_index < len(recipient_list):
-                        recipient_id, recipient_name = recipient_list[recipient_index]
-                        
-                        # 更新狀態
-                        message_forwarding[user_id]['recipient_id'] = recipient_id
-                        message_forwarding[user_id]['recipient_name'] = recipient_name
-                        message_forwarding[user_id]['stage'] = 'waiting_for_message'
-                        
-                        # 詢問用戶要發送的訊息
+                    # 檢查選擇是否有效
+                    if selected:
+                        # 更新狀態並詢問用戶要發送的訊息
                         line_bot_api.reply_message(
                             ReplyMessageRequest(
                                 reply_token=event.reply_token,
-                                messages=[TextMessage(text=f"請輸入您要發送給 {recipient_name} 的訊息：")]
+                                messages=[TextMessage(text=select_recipients(user_id, selected))]
                             )
                         )
                     else:
@@ -509,7 +2497,7 @@ def handle_message(event):
                             ReplyMessageRequest(
                                 reply_token=event.reply_token,
                                 messages=[
-                                    TextMessage(text=f"無效的選擇。請輸入1到{len(recipient_list)}之間的數字，或輸入 'cancel' 取消操作。"),
+                                    TextMessage(text=f"無效的選擇。請輸入1到{len(recipient_list)}之間的數字（多人可用 1,3,5 或 all），或輸入 'cancel' 取消操作。"),
                                     StickerMessage(package_id="11537", sticker_id="52002744")  
                                 ]
                             )
@@ -529,50 +2517,63 @@ def handle_message(event):
             elif message_forwarding[user_id]['stage'] == 'waiting_for_message':
                 # 用戶正在輸入訊息內容
                 message_content = text
-                recipient_id = message_forwarding[user_id]['recipient_id']
-                recipient_name = message_forwarding[user_id]['recipient_name']
+                recipients = message_forwarding[user_id]['recipients']
+                
+                # 發送前先檢查速率限制與訊息額度，不通過時保留狀態讓用戶稍後再輸入一次
+                rejection = check_forward_allowed(user_id, len(recipients))
+                if rejection:
+                    try:
+                        line_bot_api.reply_message(
+                            ReplyMessageRequest(
+                                reply_token=event.reply_token,
+                                messages=[
+                                    TextMessage(text=rejection),
+                                    StickerMessage(package_id="11537", sticker_id="52002753")  # 抱歉貼圖
+                                ]
+                            )
+                        )
+                    except Exception as e:
+                        app.logger.error(f"回覆訊息錯誤: {str(e)}")
+                    return
                 
                 # 載入用戶資料以獲取發送者名稱
-                user_data = load_user_data()
-                sender_name = user_data[user_id]['name']
+                sender_name = get_user_directory().get_name(user_id)
+                
+                # 發送訊息給所有接收者
+                delivered, failed = forward_message(
+                    line_bot_api,
+                    recipients,
+                    [
+                        TextMessage(text=f"來自 {sender_name} 的訊息：\n\n{message_content}"),
+                        StickerMessage(package_id="11537", sticker_id="52002736")  # 收到訊息貼圖
+                    ]
+                )
                 
-                # 發送訊息給接收者
+                # 一次回覆所有接收者的發送結果
                 try:
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=recipient_id,
-                            messages=[
-                                TextMessage(text=f"來自 {sender_name} 的訊息：\n\n{message_content}"),
-                                StickerMessage(package_id="11537", sticker_id="52002736")  # 收到訊息貼圖
-                            ]
-                        )
-                    )
-                    
-                    # 通知發送者訊息已發送，並顯示功能選單
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(text=f"成功發送給 {recipient_name}   (*´з｀*) "),
-                                # StickerMessage(package_id="446", sticker_id="2010"),  # 成功發送貼圖
-                            ]
+                    if delivered:
+                        line_bot_api.reply_message(
+                            ReplyMessageRequest(
+                                reply_token=event.reply_token,
+                                messages=[
+                                    TextMessage(text=create_forward_report(delivered, failed)),
+                                    # StickerMessage(package_id="446", sticker_id="2010"),  # 成功發送貼圖
+                                ]
+                            )
                         )
-                    )
-                except Exception as e:
-                    app.logger.error(f"發送訊息錯誤: {str(e)}")
-                    # 通知發送者訊息發送失敗
-                    try:
+                    else:
+                        # 通知發送者訊息發送失敗
                         line_bot_api.reply_message(
                             ReplyMessageRequest(
                                 reply_token=event.reply_token,
                                 messages=[
-                                    TextMessage(text=f"發送訊息失敗：{str(e)}"),
+                                    TextMessage(text=f"發送訊息失敗：{failed[0][1]}"),
                                     StickerMessage(package_id="11537", sticker_id="52002752")  # 失敗貼圖
                                 ]
                             )
                         )
-                    except Exception as inner_e:
-                        app.logger.error(f"回覆錯誤訊息時發生錯誤: {str(inner_e)}")
+                except Exception as e:
+                    app.logger.error(f"回覆訊息錯誤: {str(e)}")
                 
                 # 清除訊息轉發狀態
                 del message_forwarding[user_id]
@@ -582,10 +2583,6 @@ def handle_message(event):
             if user_id in message_forwarding:
                 del message_forwarding[user_id]
                 try:
-                    # 載入用戶資料以獲取名稱
-                    user_data = load_user_data()
-                    user_name = user_data[user_id]['name']
-                    
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -615,9 +2612,8 @@ def handle_message(event):
             else:
                 try:
                     # 載入用戶資料以獲取名稱
-                    user_data = load_user_data()
-                    if user_id in user_data:
-                        user_name = user_data[user_id]['name']
+                    user_name = get_user_directory().get_name(user_id)
+                    if user_name is not None:
                         line_bot_api.reply_message(
                             ReplyMessageRequest(
                                 reply_token=event.reply_token,
@@ -662,8 +2658,6 @@ def handle_message(event):
         elif text.lower() == "intro":
             # 檢查用戶是否已註冊
             if is_user_registered(user_id):
-                user_data = load_user_data()
-                user_name = user_data[user_id]['name']
                 try:
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
@@ -724,10 +2718,6 @@ def handle_message(event):
             users = get_all_user_names()
             if len(users) <= 1:  # 只有當前用戶
                 try:
-                    # 載入用戶資料以獲取名稱
-                    user_data = load_user_data()
-                    user_name = user_data[user_id]['name']
-                    
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -785,6 +2775,26 @@ def handle_message(event):
                             "align": "center"
                         }
                     ] + recipient_buttons + [
+                        {
+                            "type": "button",
+                            "style": "primary",
+                            "color": "#8B5A2B",  # 中咖啡色
+                            "action": {
+                                "type": "postback",
+                                "label": "全部用戶",
+                                "data": "recipient_all",
+                                "displayText": "我要發送訊息給全部用戶"
+                            },
+                            "margin": "md"
+                        },
+                        {
+                            "type": "text",
+                            "text": "也可以直接輸入編號同時發送給多人，例如 1,3,5",
+                            "margin": "md",
+                            "size": "xs",
+                            "align": "center",
+                            "wrap": True
+                        },
                         {
                             "type": "button",
                             "style": "secondary",
@@ -803,8 +2813,7 @@ def handle_message(event):
             # 初始化訊息轉發狀態
             message_forwarding[user_id] = {
                 'stage': 'waiting_for_recipient',
-                'recipient_id': None,
-                'recipient_name': None,
+                'recipients': [],
                 'recipient_list': recipient_list  # 儲存接收者列表，以便後續通過索引查找
             }
             
@@ -813,7 +2822,7 @@ def handle_message(event):
                 line_bot_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="選擇收件人", contents=FlexContainer.from_dict(flex_content))]
+                        messages=[FlexMessage(alt_text="選擇收件人", contents=flex_from_dict(flex_content))]
                     )
                 )
             except Exception as e:
@@ -828,7 +2837,7 @@ def handle_message(event):
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
-                            messages=[TextMessage(text=f"你想發送訊息給  $ $\n======================\n{user_list_text}\n======================\n 請直接輸入數字(無需括號)  ‼️ ", emojis=emojis)]
+                            messages=[TextMessage(text=f"你想發送訊息給  $ $\n======================\n{user_list_text}\n======================\n 請直接輸入數字(無需括號)，多人可用 1,3,5 或 all  ‼️ ", emojis=emojis)]
                         )
                     )
                 except Exception as inner_e:
@@ -841,13 +2850,12 @@ def handle_message(event):
         elif text=="功能列表"or text.lower() == "func_list":
             # 檢查用戶是否已註冊
             if is_user_registered(user_id):
-                user_data = load_user_data()
                 try:
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
                             messages=[
-                                create_function_menu(user_data[user_id]['name'])
+                                create_function_menu(get_user_directory().get_name(user_id))
                             ]
                         )
                     )
@@ -882,8 +2890,7 @@ def handle_message(event):
                     )
                 else:
                     # 用戶已註冊，但不顯示功能選單，只回覆訊息
-                    user_data = load_user_data()
-                    user_name = user_data[user_id]['name']
+                    user_name = get_user_directory().get_name(user_id)
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -912,9 +2919,11 @@ def handle_message(event):
 
 # 處理 Postback 事件
 @line_handler.add(PostbackEvent)
+@traced_event
+@offers_unused_reply_token
 def handle_postback(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    with shared_api_client() as api_client:
+        line_bot_api = GuardedMessagingApi(api_client)
         user_id = event.source.user_id
         data = event.postback.data
         
@@ -923,24 +2932,22 @@ def handle_postback(event):
             # 檢查用戶是否在訊息轉發流程中
             if user_id in message_forwarding and message_forwarding[user_id]['stage'] == 'waiting_for_recipient':
                 try:
-                    # 從 postback 數據中獲取收件人索引
-                    recipient_index = int(data.split("_")[1])
                     recipient_list = message_forwarding[user_id]['recipient_list']
                     
-                    # 檢查索引是否有效
-                    if 0 <= recipient_index < len(recipient_list):
-                        recipient_id, recipient_name = recipient_list[recipient_index]
-                        
-                        # 更新狀態
-                        message_forwarding[user_id]['recipient_id'] = recipient_id
-                        message_forwarding[user_id]['recipient_name'] = recipient_name
-                        message_forwarding[user_id]['stage'] = 'waiting_for_message'
-                        
-                        # 詢問用戶要發送的訊息
+                    # 從 postback 數據中獲取收件人索引（recipient_all 表示全部用戶）
+                    if data == "recipient_all":
+                        selected = list(recipient_list)
+                    else:
+                        recipient_index = int(data.split("_")[1])
+                        selected = [recipient_list[recipient_index]] if 0 <= recipient_index < len(recipient_list) else []
+                    
+                    # 檢查選擇是否有效
+                    if selected:
+                        # 更新狀態並詢問用戶要發送的訊息
                         line_bot_api.reply_message(
                             ReplyMessageRequest(
                                 reply_token=event.reply_token,
-                                messages=[TextMessage(text=f"請輸入您要發送給 {recipient_name} 的訊息：")]
+                                messages=[TextMessage(text=select_recipients(user_id, selected))]
                             )
                         )
                     else:
@@ -1012,10 +3019,6 @@ def handle_postback(event):
             users = get_all_user_names()
             if len(users) <= 1:  # 只有當前用戶
                 try:
-                    # 載入用戶資料以獲取名稱
-                    user_data = load_user_data()
-                    user_name = user_data[user_id]['name']
-                    
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -1040,8 +3043,7 @@ def handle_postback(event):
             # 初始化訊息轉發狀態
             message_forwarding[user_id] = {
                 'stage': 'waiting_for_recipient',
-                'recipient_id': None,
-                'recipient_name': None,
+                'recipients': [],
                                 'recipient_list': recipient_list  # 儲存接收者列表，以便後續通過索引查找
             }
             
@@ -1050,20 +3052,86 @@ def handle_postback(event):
                 line_bot_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"請輸入您要發送訊息的用戶編號：\n\n{user_list_text}\n\n(請直接輸入數字編號)")]
+                        messages=[TextMessage(text=f"請輸入您要發送訊息的用戶編號：\n\n{user_list_text}\n\n(請直接輸入數字編號，多人可用 1,3,5 或 all)")]
                     )
                 )
             except Exception as e:
                 app.logger.error(f"回覆訊息錯誤: {str(e)}")
 
+# 預熱：在開始接收請求前先載入用戶目錄與索引、建立 Flex 範本並建立 LINE API 連線，成功時回傳 True
+def warm_up():
+    started = time.monotonic()
+    try:
+        directory = get_user_directory()
+        create_register_prompt()
+        get_api_client()
+        if WARMUP_CONNECT and os.getenv('CHANNEL_ACCESS_TOKEN'):
+            try:
+                # 取得 Bot 資訊不會消耗訊息額度，順便建立好 TLS 連線
+                GuardedMessagingApi(get_api_client()).get_bot_info(_request_timeout=LINE_REQUEST_TIMEOUT)
+            except Exception as e:
+                app.logger.warning(f"預熱 LINE API 連線失敗: {str(e)}")
+        app_ready.set()
+        app.logger.info(f"預熱完成，載入 {len(directory)} 位用戶，耗時 {time.monotonic() - started:.2f} 秒")
+        return True
+    except Exception as e:
+        app.logger.error(f"預熱失敗: {str(e)}")
+        return False
+
+# 反覆預熱直到成功（例如資料庫暫時被鎖住），失敗後的等待時間逐次加倍
+def warm_up_until_ready():
+    delay = 1
+    while not warm_up():
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_RETRY_MAX_DELAY)
+
+warm_up_started = False
+warm_up_lock = threading.Lock()
+
+# 在背景開始預熱（每個程序只會啟動一次）
+def start_warm_up():
+    global warm_up_started
+    if warm_up_started or app_ready.is_set():
+        return
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+    threading.Thread(target=warm_up_until_ready, daemon=True).start()
+
+# 網頁伺服器收到請求時才開始預熱，只有實際提供服務的程序會預熱
+@app.before_request
+def ensure_warm_up_started():
+    start_warm_up()
+
+# 存活檢查：程序還在就回傳 OK
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    return 'OK'
+
+# 就緒檢查：預熱完成後才回傳 200，負載平衡器據此決定是否送流量進來
+@app.route("/readyz", methods=['GET'])
+def readyz():
+    if not app_ready.is_set():
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'users': len(get_user_directory())})
+
+# 明確設定 WARMUP_ON_START=1 時，以 gunicorn 等方式匯入後就在背景預熱，不阻塞匯入
+if WARMUP_ON_START and __name__ != "__main__":
+    start_warm_up()
+
+# 以 gunicorn 等方式啟動時不會執行 __main__，可透過環境變數讓每個 worker 啟動背景任務
+if os.getenv('START_ANNOUNCEMENT_CHECKER') == '1' and ANNOUNCEMENT_DELIVERY != 'worker' and __name__ != "__main__":
+    start_announcement_checker()
+
 # 主程式入口
 if __name__ == "__main__":
-    # 確保用戶資料檔案存在且格式正確
-    load_user_data()
-        # 啟動背景任務
-    announcement_thread = threading.Thread(target=announcement_checker)
-    announcement_thread.daemon = True  # 設為守護線程，主程序結束時自動終止
-    announcement_thread.start()
+    # 先完成預熱（載入用戶目錄）再開始接收請求；失敗時改在背景重試
+    if not warm_up():
+        start_warm_up()
+    # 啟動背景任務（改由獨立的 announcement_worker 程序發送時則不啟動）
+    if ANNOUNCEMENT_DELIVERY != 'worker':
+        start_announcement_checker()
    
     app.run(debug=True, port=5001)
 
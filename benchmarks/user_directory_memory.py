@@ -0,0 +1,59 @@
+# 比較用戶資料在記憶體中的大小：舊的 dict-of-dicts 與 UserDirectory
+# 使用方式：python benchmarks/user_directory_memory.py --users 1000000
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import UserDirectory  # noqa: E402
+
+
+# 產生與 user_data.json 相同格式的測試資料（JSON 字串）
+def make_user_data_json(count):
+    base = 1700000000000
+    return json.dumps({
+        f"U{i:032x}": {"name": f"user{i}", "registered_at": base + i}
+        for i in range(count)
+    })
+
+
+# 量測 build() 建立的物件在記憶體中保留多少位元組
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用戶目錄記憶體比較')
+    parser.add_argument('--users', type=int, default=1000000)
+    args = parser.parse_args()
+
+    content = make_user_data_json(args.users)
+
+    user_data, dict_current, dict_peak, dict_time = measure(lambda: json.loads(content))
+    del user_data
+
+    directory, dir_current, dir_peak, dir_time = measure(lambda: UserDirectory(json.loads(content).items()))
+    del directory
+
+    mb = 1024 * 1024
+    print(f"users: {args.users}")
+    print(f"dict-of-dicts : retained {dict_current / mb:8.1f} MB, peak {dict_peak / mb:8.1f} MB, load {dict_time:.2f}s")
+    print(f"UserDirectory : retained {dir_current / mb:8.1f} MB, peak {dir_peak / mb:8.1f} MB, load {dir_time:.2f}s")
+    print(f"saved         : {(1 - dir_current / dict_current) * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
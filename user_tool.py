@@ -0,0 +1,146 @@
+# 用戶資料匯入／匯出工具
+# 使用方式：
+#   python -m user_tool import users.csv             匯入 CSV（欄位：user_id,name[,registered_at][,tags]，多個標籤以 ; 分隔）
+#   python -m user_tool import users.jsonl           匯入 JSONL（每行 {"user_id", "name", "registered_at"[, "tags"]}）
+#   python -m user_tool import users.csv --dry-run   只檢查不寫入
+#   python -m user_tool export users.jsonl           匯出為 JSONL（不指定檔案則輸出到標準輸出）
+# 匯入時逐筆檢查，有任何錯誤就不寫入；寫入前會先備份原本的用戶資料
+# 沒有 tags 欄位的紀錄會保留用戶原本的標籤
+import argparse
+import csv
+import json
+import re
+import sys
+
+import app as bot
+
+
+# LINE 用戶 ID 的格式
+USER_ID_PATTERN = re.compile(r'^U[0-9a-f]{32}$')
+# 用戶名稱最長字數
+MAX_NAME_LENGTH = 100
+# 標籤最長字數
+MAX_TAG_LENGTH = 50
+# CSV 中多個標籤的分隔字元
+CSV_TAG_SEPARATOR = ';'
+# 最多列出幾筆錯誤
+MAX_REPORTED_ERRORS = 50
+
+
+# 依副檔名判斷格式
+def detect_format(path):
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+# 逐筆讀取匯入檔並檢查格式，產生 (行號, 紀錄)；有問題的行產生 (行號, 錯誤訊息字串)
+def iter_import_records(path, fmt):
+    decode = json.JSONDecoder().raw_decode
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                # 空白的 tags 欄位視為沒有提供，保留原本的標籤
+                if row.get('tags'):
+                    row['tags'] = row['tags'].split(CSV_TAG_SEPARATOR)
+                else:
+                    row.pop('tags', None)
+                yield reader.line_num, normalize_record(row)
+        else:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = decode(line)[0]
+                except json.JSONDecodeError as e:
+                    yield line_num, f"JSON 格式錯誤: {e}"
+                    continue
+                yield line_num, normalize_record(record)
+
+
+# 檢查並整理單筆紀錄，回傳整理後的紀錄或錯誤訊息字串
+def normalize_record(record):
+    if not isinstance(record, dict):
+        return "格式錯誤"
+    user_id = record.get('user_id') or ''
+    name = record.get('name') or ''
+    registered_at = record.get('registered_at') or 0
+
+    if not isinstance(user_id, str) or not USER_ID_PATTERN.match(user_id):
+        return f"無效的 user_id: {user_id!r}"
+    if isinstance(name, str):
+        name = name.strip()
+    if not isinstance(name, str) or not name or len(name) > MAX_NAME_LENGTH:
+        return f"無效的名稱: {name!r}"
+    if not isinstance(registered_at, int):
+        try:
+            registered_at = int(registered_at)
+        except (TypeError, ValueError):
+            return f"無效的 registered_at: {registered_at!r}"
+    normalized = {'user_id': user_id, 'name': name, 'registered_at': registered_at}
+
+    if 'tags' in record:
+        tags = record['tags']
+        if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            return f"無效的標籤: {tags!r}"
+        tags = [tag.strip() for tag in tags if tag.strip()]
+        if any(len(tag) > MAX_TAG_LENGTH for tag in tags):
+            return f"標籤過長: {tags!r}"
+        normalized['tags'] = tags
+    return normalized
+
+
+def import_users(args):
+    fmt = args.format or detect_format(args.path)
+    count, errors, backup_file = bot.bulk_upsert_users(iter_import_records(args.path, fmt), dry_run=args.dry_run)
+
+    if errors:
+        for error in errors[:MAX_REPORTED_ERRORS]:
+            print(error, file=sys.stderr)
+        if len(errors) > MAX_REPORTED_ERRORS:
+            print(f"...另有 {len(errors) - MAX_REPORTED_ERRORS} 筆錯誤", file=sys.stderr)
+        print(f"共 {len(errors)} 筆錯誤，未匯入任何資料", file=sys.stderr)
+        return 1
+
+    if args.dry_run:
+        print(f"檢查通過，共 {count} 筆（未寫入）")
+        return 0
+
+    print(f"已匯入 {count} 筆用戶資料" + (f"，原資料備份於 {backup_file}" if backup_file else ""))
+    return 0
+
+
+def export_users(args):
+    directory = bot.get_user_directory()
+    out = open(args.path, 'w', encoding='utf-8') if args.path else sys.stdout
+    try:
+        for user_id in directory.user_ids:
+            out.write(json.dumps(dict(user_id=user_id, **directory.get(user_id)), ensure_ascii=False))
+            out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if args.path:
+        print(f"已匯出 {len(directory)} 筆用戶資料到 {args.path}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Bot 用戶資料匯入／匯出')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='從 CSV／JSONL 匯入用戶')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], help='檔案格式（預設依副檔名判斷）')
+    import_parser.add_argument('--dry-run', action='store_true', help='只檢查不寫入')
+
+    export_parser = subparsers.add_parser('export', help='匯出用戶為 JSONL')
+    export_parser.add_argument('path', nargs='?', help='輸出檔案（預設為標準輸出）')
+
+    args = parser.parse_args()
+    if args.command == 'import':
+        return import_users(args)
+    return export_users(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())